@@ -15,10 +15,36 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from importlib import import_module
+
 from .__version__ import __version__
-from .pirecorder import *
-from .camconfig import Camconfig
-from .convert import Convert
-from .schedule import Schedule
-from .stream import Stream
-from .videoin import VideoIn
+
+# Submodules are only imported when first accessed, such that each entry point
+# (e.g. a scheduled recording) only loads the dependencies it actually uses
+_modules = {"PiRecorder": ".pirecorder",
+            "rec": ".pirecorder",
+            "Camconfig": ".camconfig",
+            "Convert": ".convert",
+            "Daemon": ".daemon",
+            "H264Index": ".h264index",
+            "Offload": ".offload",
+            "OffloadServer": ".offload",
+            "Schedule": ".schedule",
+            "Stream": ".stream",
+            "VideoIn": ".videoin"}
+
+__all__ = ["__version__"] + list(_modules)
+
+def __getattr__(name):
+
+    if name not in _modules:
+        raise AttributeError("module 'pirecorder' has no attribute "+repr(name))
+    value = getattr(import_module(_modules[name], __name__), name)
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+
+    return sorted(list(globals()) + list(_modules))
@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import yaml
+from ast import literal_eval
+from localconfig import LocalConfig
+
+rectypes = ["img", "imgseq", "imgburst", "rawseq", "vid", "vidseq", "vidseg",
+            "vidbuf"]
+
+_files = {}
+_snapshots = {}
+
+def _stamp(filename):
+
+    stat = os.stat(filename)
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _read(filename):
+
+    """Returns the content of a file, read again only when it changed"""
+
+    stamp = _stamp(filename)
+    if filename not in _files or _files[filename]["stamp"] != stamp:
+        with open(filename) as f:
+            text = f.read()
+        _files[filename] = {"stamp": stamp, "text": text}
+
+    return _files[filename]
+
+
+def loadconfig(filename):
+
+    """Returns the configuration stored in filename as a LocalConfig instance"""
+
+    config = LocalConfig(compact_form = True)
+    if os.path.isfile(filename):
+        config.read(_read(filename)["text"])
+
+    return config
+
+
+def copyconfig(config):
+
+    """Returns an independent copy of a configuration"""
+
+    copy = LocalConfig(compact_form = True)
+    copy.read(str(config))
+
+    return copy
+
+
+def saveconfig(config, filename):
+
+    """
+    Stores the configuration in filename, only if its content changed. The file
+    is replaced atomically, such that readers never see a partially written
+    file. Returns if the file was written.
+    """
+
+    text = str(config)
+    if os.path.isfile(filename) and _read(filename)["text"] == text:
+        return False
+
+    tmpfile = filename + ".tmp"
+    with open(tmpfile, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpfile, filename)
+    _files[filename] = {"stamp": _stamp(filename), "text": text}
+
+    return True
+
+
+def loadyml(filename):
+
+    """Returns the content of a yaml file, parsed again only when it changed"""
+
+    cached = _read(filename)
+    if "value" not in cached:
+        cached["value"] = yaml.load(cached["text"], Loader=yaml.FullLoader)
+
+    return cached["value"]
+
+
+def _parse(value, name, length, types = (int, float)):
+
+    if isinstance(value, str):
+        try:
+            value = literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise ValueError(name+" could not be parsed: "+value)
+    if not isinstance(value, (tuple, list)) or len(value) != length:
+        raise ValueError(name+" should be a tuple of "+str(length)+" values")
+    if not all(isinstance(i, types) for i in value):
+        raise ValueError(name+" should only contain numbers")
+
+    return tuple(value)
+
+
+def _check(value, name, minval, maxval):
+
+    if value is None:
+        return
+    if not minval <= value <= maxval:
+        raise ValueError(name+" should be between "+str(minval)+" and "+\
+                         str(maxval)+", not "+str(value))
+
+
+class Snapshot:
+
+    """
+    Typed and validated values of a pirecorder configuration. Tuple values
+    that are stored as strings in the configuration file are parsed once, and
+    a ValueError is raised for invalid values.
+    """
+
+    def __init__(self, config):
+
+        self.rectype = config.rec.rectype
+        if self.rectype not in rectypes:
+            raise ValueError("rectype should be one of "+", ".join(rectypes))
+
+        self.imgdims = _parse(config.img.imgdims, "imgdims", 2, int)
+        self.viddims = _parse(config.vid.viddims, "viddims", 2, int)
+        self.gains = tuple(float(i) for i in _parse(config.cus.gains, "gains", 2))
+        self.roi = config.cus.roi
+        if self.roi is not None:
+            self.roi = _parse(self.roi, "roi", 4)
+            for value in self.roi:
+                _check(value, "roi", 0, 1)
+
+        for dim in self.imgdims + self.viddims:
+            _check(dim, "dims", 16, 8000)
+        for gain in self.gains:
+            _check(gain, "gains", 0, 8)
+        if config.cus.rotation not in [0, 90, 180, 270]:
+            raise ValueError("rotation should be 0, 90, 180, or 270")
+        if config.cam.iso not in [0, 100, 200, 320, 400, 500, 640, 800]:
+            raise ValueError("iso should be one of 100, 200, 320, 400, 500, "+\
+                             "640, 800")
+        _check(config.cam.brightness, "brightness", 0, 100)
+        _check(config.cam.contrast, "contrast", -100, 100)
+        _check(config.cam.saturation, "saturation", -100, 100)
+        _check(config.cam.sharpness, "sharpness", -100, 100)
+        _check(config.cam.compensation, "compensation", -25, 25)
+        _check(config.cam.shutterspeed, "shutterspeed", 0, 10000000)
+        _check(config.img.imgquality, "imgquality", 1, 100)
+        _check(config.vid.vidquality, "vidquality", 0, 40)
+        _check(config.vid.vidfps, "vidfps", 0.1, 120)
+        _check(config.img.imgwait, "imgwait", 0, 86400)
+        if config.img.rawformat not in [None, "gray", "yuv"]:
+            raise ValueError("rawformat should be gray or yuv")
+
+
+def snapshot(config):
+
+    """Returns a Snapshot of the configuration, cached by its content"""
+
+    text = str(config)
+    if text not in _snapshots:
+        if len(_snapshots) >= 16:
+            _snapshots.clear()
+        _snapshots[text] = Snapshot(config)
+
+    return _snapshots[text]
@@ -18,23 +18,204 @@ limitations under the License.
 from __future__ import print_function
 
 import os
+import re
 import cv2
 import ast
 import sys
 import time
 import glob
+import shutil
+import signal
 import argparse
 import subprocess
 
+from collections import deque
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from multiprocess import Pool
 from pythutils.sysutils import lineprint
-from pythutils.drawutils import draw_text
 from pythutils.fileutils import listfiles, get_ext, commonpref, move
 from pythutils.mediautils import get_vid_params, videowriter, imgresize
 
+from .index import ConvIndex
+from .jobs import JobQueue
+from .lock import recording
+from .metrics import cputemp, memavailable, throttled
+
 class KeyboardInterruptError(Exception): pass
 
+class JobCancelled(Exception): pass
+
+_footprint = 100
+
+def _lowpriority(pid):
+
+    """Lowers the cpu and i/o priority of a process to the minimum"""
+
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, 19)
+        if shutil.which("ionice") is not None:
+            subprocess.call(["ionice", "-c", "3", "-p", str(pid)])
+    except OSError:
+        pass
+
+
+def _marker(filein, outdir):
+
+    return os.path.join(outdir, ".cancel_"+os.path.basename(filein))
+
+
+def cancel(filein, outdir = ""):
+
+    """
+    Cancels the conversion of filein by a running Convert instance that
+    stores its videos in outdir (by default the directory of filein)
+    """
+
+    outdir = os.path.dirname(os.path.abspath(filein)) if outdir == "" else outdir
+    open(_marker(filein, outdir), "w").close()
+
+
+def _ignoreint():
+
+    """Lets pool workers ignore ctrl+c, such that the parent can stop them"""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+_filters = None
+
+def hasfilter(name):
+
+    """Returns if the installed ffmpeg provides the video filter name"""
+
+    global _filters
+    if _filters is None:
+        try:
+            out = subprocess.check_output(["ffmpeg", "-hide_banner", "-filters"],
+                                          stderr = subprocess.DEVNULL)
+            _filters = [l.split()[1] for l in out.decode().splitlines()
+                        if len(l.split()) > 2 and "->" in l.split()[2]]
+        except (OSError, subprocess.CalledProcessError):
+            _filters = []
+
+    return name in _filters
+
+
+_seqpattern = re.compile(r"^(.+_\d{6}_[^_]+)_im(\d+)_(\d{6})\.\w+$")
+
+def _seqname(files):
+
+    if len(set(files)) == 1:
+        return os.path.splitext(files[0])[0]
+
+    return commonpref(files)
+
+
+def imgsequences(files):
+
+    """
+    Groups image files into the sequences they were recorded in, based on the
+    label, date, and host in their names (e.g. test_180708_pi12_im001_100410),
+    with a new sequence starting when the image counter restarts. Files that
+    do not follow this pattern form a single sequence. Returns the name and
+    the files of each sequence. The first sequence of a label, date, and host
+    is named by the common prefix of its files, later sequences by the label,
+    date, and host followed by the time of their first image, such that the
+    name of a sequence does not depend on the other sequences in files.
+    """
+
+    groups, other = {}, []
+    for filename in sorted(files):
+        match = _seqpattern.match(os.path.basename(filename))
+        if match is None:
+            other.append(filename)
+            continue
+        groups.setdefault(match.group(1), []).append((match.group(3),
+                                                      int(match.group(2)),
+                                                      filename))
+
+    named = []
+    for key in sorted(groups):
+        images = groups[key]
+        counters = [counter for _, counter, _ in images]
+        if len(set(counters)) == len(counters):
+            sequences = [[f for _, _, f in sorted(images, key = lambda i: i[1])]]
+        else:
+            sequences, current, last = [], [], None
+            for _, counter, filename in sorted(images):
+                if last is not None and counter <= last:
+                    sequences.append(current)
+                    current = []
+                current.append(filename)
+                last = counter
+            sequences.append(current)
+        named.append((_seqname(sequences[0]), sequences[0]))
+        for files in sequences[1:]:
+            first = _seqpattern.match(os.path.basename(files[0])).group(3)
+            named.append((os.path.join(os.path.dirname(files[0]),
+                                       key+"_"+first), files))
+    if len(other) > 0:
+        name = _seqname(other)
+        if name in [n for n, _ in named]:
+            name += "_"+str(len(named))
+        named.append((name, other))
+
+    return named
+
+
+_reduced = {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4,
+            2: cv2.IMREAD_REDUCED_COLOR_2}
+
+def decode(filename, resizeval = 1):
+
+    """
+    Reads and resizes an image. For resizevals of 0.5 and smaller the jpeg is
+    decoded directly at 1/2, 1/4 or 1/8 of its size, which avoids decoding it
+    at full resolution.
+    """
+
+    factor = 1
+    for reduction in [8, 4, 2]:
+        if resizeval * reduction <= 1:
+            factor = reduction
+            break
+    if factor > 1:
+        frame = cv2.imread(filename, _reduced[factor])
+    else:
+        frame = cv2.imread(filename)
+    if frame is not None and resizeval * factor != 1:
+        frame = imgresize(frame, resizeval * factor)
+
+    return frame
+
+
+def decodeframes(filenames, resizeval = 1, workers = 4, readahead = 8):
+
+    """
+    Generates the filename and decoded image of each file in order, while
+    up to readahead images are decoded ahead in parallel by workers threads
+    (OpenCV releases the GIL while decoding). Memory use is bounded by the
+    number of images decoded ahead.
+    """
+
+    pending = deque()
+    files = iter(filenames)
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as executor:
+        try:
+            for filename in files:
+                pending.append((filename, executor.submit(decode, filename,
+                                                          resizeval)))
+                if len(pending) >= max(1, readahead):
+                    filename, future = pending.popleft()
+                    yield filename, future.result()
+            while len(pending) > 0:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
 class Convert:
 
     """
@@ -52,27 +233,88 @@ class Convert:
         does not exist yet it will be newly created.
     type : str, default = ".h264"
         The filetype of the media to convert.
-    withframe : bool, default = False
-        Type of conversion, either very fast conversion using FFmpeg or using
-        OpenCV to draw the frame number on each video frame.
+    withframe : bool or str, default = False
+        If the frame number should be drawn on each video frame. With True the
+        frame numbers are drawn by FFmpeg's drawtext filter while re-encoding,
+        without decoding the frames in Python. With "opencv", or when FFmpeg
+        lacks the drawtext filter, frames are decoded, drawn on, and encoded
+        one by one with OpenCV, which is much slower.
+    crf : int, default = 23
+        Constant rate factor of the h264 (libx264) encoder when videos are
+        re-encoded by FFmpeg, from 0 (lossless) to 51 (smallest files).
     delete : bool, default = False
         If the original videos should be deleted or not.
-    pools : int, default = 4
+    pools : int or str, default = 4
         Number of simultaneous converting processing that should be allowed.
         Works optimally when equal to the number of computer processing cores.
+        With "auto", up to one process per core is started and the number of
+        simultaneous conversions is adjusted every 10 seconds: it is lowered
+        when the load average exceeds the number of cores, the cpu reaches
+        80 degrees or is throttled, or the available memory does not fit
+        another conversion (based on the largest memory use of conversions so
+        far), and raised when cores are idle and videos are waiting.
     resizeval : float, default = 1
         Float value to which the video should be resized.
+    chunkdur : float, default = None
+        If provided, each h264 video is split losslessly at keyframes into
+        chunks of about chunkdur seconds that are converted in parallel and
+        joined again without re-encoding, such that a single long video uses
+        all processing cores. Frame numbers drawn with withframe continue
+        across chunks. Keyframes are found with the keyframe index that is
+        stored next to each video (see H264Index). Requires fps to be set
+        correctly, by default 25.
     imgfps : int, default = 25
-        Framerate for conversion of images to video.
+        Framerate for conversion of images to video. Images are grouped into
+        the sequences they were recorded in, based on the label, date and host
+        in their names, and each sequence is converted to its own video, with
+        multiple sequences converted in parallel. Images are decoded and
+        encoded one at a time, such that memory use does not depend on the
+        number of images.
+    readahead : int, default = 8
+        Number of images that are decoded ahead of the video encoder when
+        converting images to video, in parallel by pools threads.
+    priority : str, default = None
+        Order in which videos are converted, either "newest" or "oldest" file
+        first, "shortest" or "longest" file first (by file size), or None for
+        alphabetical order. Videos that arrive while watching the folder are
+        queued by the same order, such that they can overtake waiting videos.
+        A single video can be cancelled, without affecting the others, with
+        the cancel function, or by creating an empty ".cancel_<videoname>"
+        file in outdir. Cancelled videos are not converted again unless they
+        change or overwrite is True.
+    throttle : bool, default = False
+        If conversion should give way to recordings on the same computer.
+        While a recording is active, detected with the recording lock that
+        record maintains, at most recpools videos are converted at a time,
+        FFmpeg runs single-threaded at the lowest cpu and idle i/o priority,
+        and fewer images are decoded in parallel. New conversions run at full
+        speed again once the recording ends.
+    recpools : int, default = 1
+        Number of simultaneous conversions while a recording is active.
+    lockfile : str, default = None
+        The recording lock file, by default the recording.lock file in the
+        pirecorder folder.
+    overwrite : bool, default = False
+        If files that were converted before should be converted again. Each
+        conversion is registered in an index in outdir, such that files are
+        only skipped when their conversion finished and the output is intact,
+        and interrupted conversions are redone.
     sleeptime : int, default = None
-        Time in seconds between subsequent checks for files within a folder. The
-        default value (None) only converts the current files.
+        If provided, the folder is watched for new files after converting the
+        current files, and files are converted as soon as they are completely
+        written, with the converting processes kept alive in between. Image
+        sequences are converted once no new images arrived for sleeptime
+        seconds. Where inotify is not available, the folder is checked every
+        sleeptime seconds. The default value (None) only converts the current
+        files.
     """
 
     def __init__(self, indir = "", outdir = "", type = ".h264",
                  withframe = False, overwrite = False, delete = False,
                  pools = 4, resizeval = 1, fps = None, imgfps = 25,
-                 internal = False, sleeptime = None):
+                 internal = False, sleeptime = None, readahead = 8,
+                 chunkdur = None, crf = 23, priority = None,
+                 throttle = False, recpools = 1, lockfile = None):
 
         if internal:
             lineprint("Running convert function..", label="pirecorder")
@@ -88,130 +330,676 @@ class Convert:
 
         self.type = type
         self.withframe = withframe
+        if withframe is True and not hasfilter("drawtext"):
+            lineprint("FFmpeg has no drawtext filter, drawing frame numbers "+\
+                      "with OpenCV..", label="pirecorder")
+            self.withframe = "opencv"
+        self.crf = int(crf)
+        assert priority in [None, "newest", "oldest", "shortest", "longest"],\
+            "priority should be newest, oldest, shortest, longest, or None.."
+        self.priority = priority
+        self.throttle = throttle
+        self.auto = pools == "auto"
+        if self.auto:
+            pools = os.cpu_count() or 1
+        self.recpools = max(1, min(int(recpools), int(pools)))
+        self.lockfile = lockfile
+        self.throttled = False
         self.delete = delete
         self.pools = int(pools)
+        self.autolimit = self.pools
+        self.imgthreads = self.pools
+        self.lastload = 0
+        self.footprint = None
         self.resizeval = float(resizeval)
         self.fps = int(fps) if fps is not None else None
         self.imgfps = int(imgfps)
+        self.readahead = int(readahead)
+        self.chunkdur = chunkdur
+        self.overwrite = overwrite
         self.terminated = False
+        self.pool = None
+        self.queue = None
+        self.results = None
+        self.active = {}
+        self.index = ConvIndex(self.outdir)
 
-        while True:
-            files = listfiles(self.indir, self.type, keepdir = False)
-            old = listfiles(self.indir, self.type, keepext = False)
-            new = listfiles(self.outdir, ".mp4", keepext = False)
-            self.todo = files
-            if not overwrite:
-                self.todo = [files[i] for i,file in enumerate(old) if file not in new]
-            if self.type in [".jpg",".jpeg",".png"] and len(self.todo)>0:
-                 if len([f for f in new if commonpref(self.todo) in f])>0 and not overwrite:
-                     self.todo = []
+        try:
+            self.todo = self.listtodo()
             self.convertpool()
-            msg = "No files to convert.."
             if sleeptime == None:
                 if not self.terminated:
-                    lineprint(msg, label="pirecorder")
+                    lineprint("No files to convert..", label="pirecorder")
                 return
-            else:
-                try:
-                    lineprint(msg+" rechecking in "+str(sleeptime)+"s..", label="pirecorder")
-                    time.sleep(sleeptime)
-                except KeyboardInterrupt:
-                    lineprint("Terminating checking for files..", label="pirecorder")
-                    return
+            if not self.terminated:
+                self.watch(sleeptime)
+        finally:
+            self.stoppool()
 
-    def conv_single(self, filein):
 
-        try:
-            filebase = os.path.basename(filein)
-            fileout = filein if self.outdir == "" else self.outdir+"/"+filebase
-            lineprint("Start converting "+filebase, label="pirecorder")
+    def __getstate__(self):
 
-            if self.withframe:
-                vid = cv2.VideoCapture(filein)
-                fps, width, height, _ = get_vid_params(vid)
-                if self.fps is None:
-                    self.fps = fps
-                vidout = videowriter(fileout, width, height, self.fps, self.resizeval)
-
-                while True:
-                    flag, frame = vid.read()
-                    if flag:
-                        if self.resizeval != 1:
-                            frame = imgresize(frame, self.resizeval)
-                        frame_nr = int(vid.get(cv2.CAP_PROP_POS_FRAMES))
-                        draw_text(frame, str(frame_nr), (10,10), 0.9, col="white",
-                                  shadow=True)
-                        vidout.write(frame)
-                    if not flag:
-                        break
+        state = self.__dict__.copy()
+        state["pool"] = None
+        state["queue"] = None
+        state["results"] = None
+        state["active"] = {}
 
-            else:
-                if self.resizeval != 1:
-                    comm = "' -vf 'scale=iw*" + str(self.resizeval) + ":-2' '"
+        return state
+
+
+    def listtodo(self):
+
+        """
+        Returns the files in indir that still need to be converted, or the
+        name and files of the image sequences that still need to be converted
+        """
+
+        files = listfiles(self.indir, self.type, keepdir = False)
+        if self.type in [".jpg",".jpeg",".png"]:
+            todo = []
+            for name, sequence in imgsequences(files):
+                source, size, mtime = self._sequence(name, sequence)
+                done = False if self.overwrite else \
+                       self.index.done(source, size, mtime)
+                if done is None:
+                    done = os.path.exists(self._seqoutput(name))
+                if not done:
+                    todo.append((name, sequence))
+            return todo
+        if self.overwrite:
+            return files
+
+        return [f for f in files if self.needed(f)]
+
+
+    def _output(self, filein):
+
+        return self.outdir+"/"+os.path.basename(filein)[:-len(self.type)]+".mp4"
+
+
+    def _seqoutput(self, name):
+
+        return self.outdir+"/"+os.path.basename(name)+".mp4"
+
+
+    def _sequence(self, name, files):
+
+        """Returns the index key, total size, and last change of a sequence"""
+
+        stats = [os.stat(f) for f in files]
+        source = os.path.abspath(name)+"*"+self.type
+
+        return source, sum(s.st_size for s in stats), max(s.st_mtime for s in stats)
+
+
+    def needed(self, filein):
+
+        """Returns if a file still needs to be converted"""
+
+        if self.overwrite:
+            return True
+        stat = os.stat(filein)
+        record = self.index.get(os.path.abspath(filein))
+        if record is not None and record["status"] == "cancelled" and \
+           (record["size"], record["mtime"]) == (stat.st_size, stat.st_mtime):
+            return False
+        done = self.index.done(os.path.abspath(filein), stat.st_size,
+                               stat.st_mtime)
+        if done is None:
+            return not os.path.exists(self._output(filein))
+
+        return not done
+
+
+    def watch(self, sleeptime):
+
+        """Converts new files as soon as they are completely written"""
+
+        from .watch import Watcher
+
+        watcher = Watcher(self.indir, self.type, interval = sleeptime)
+        images = self.type in [".jpg",".jpeg",".png"]
+        lineprint("No files to convert.. watching "+self.indir+" for new files..",
+                  label="pirecorder")
+        pending, lastfile = False, 0
+        try:
+            while not self.terminated:
+                busy = len(self.active) > 0
+                files = watcher.wait(0.5 if busy else
+                                     (sleeptime if pending else None))
+                if files is None:
+                    self.todo = self.listtodo()
+                elif images:
+                    if len(files) > 0:
+                        pending, lastfile = True, time.time()
+                    self.todo = []
+                    if pending and time.time() - lastfile >= sleeptime:
+                        self.todo, pending = self.listtodo(), False
                 else:
-                    comm = "' -vcodec copy '"
-                bashcomm = "ffmpeg"
-                if self.fps is not None:
-                    bashcomm = bashcomm+" -r "+ str(self.fps)
-                bashcomm = bashcomm+" -i '"+filein+comm+fileout[:-len(self.type)]+".mp4'"
-                bashcomm = bashcomm + " -y -nostats -loglevel 0"
-                output = subprocess.check_output(['bash','-c', bashcomm])
+                    self.todo = [f for f in files if self.needed(f)]
+                self.convertpool(wait = False)
+        except KeyboardInterrupt:
+            lineprint("Terminating checking for files..", label="pirecorder")
+        finally:
+            watcher.close()
+
+
+    def startpool(self):
+
+        """Starts the worker pool and the queue that feeds it"""
+
+        if self.pool is None:
+            self.checkrecording()
+            self.checkload(force = True)
+            self.queue = JobQueue(self._limit())
+            self.pool = Pool(self.pools, _ignoreint)
+            self.results = self.pool.imap_unordered(self.conv_job, self.queue)
 
-            lineprint("Finished converting "+filebase, label="pirecorder")
 
+    def stoppool(self):
+
+        """Stops the worker pool, abandoning the jobs in progress"""
+
+        if self.pool is not None:
+            self.queue.close()
+            self.pool.terminate()
+            self.pool.join()
+            self.pool, self.queue, self.results = None, None, None
+        self.active = {}
+
+
+    def _priority(self, filein):
+
+        stats = [os.stat(f) for f in (filein if isinstance(filein, list)
+                                      else [filein])]
+        mtime = max(stat.st_mtime for stat in stats)
+        size = sum(stat.st_size for stat in stats)
+        priorities = {None: 0, "newest": -mtime, "oldest": mtime,
+                      "shortest": size, "longest": -size}
+
+        return priorities[self.priority]
+
+
+    def submit(self, filein):
+
+        """Queues the conversion of a video, split in chunks if requested"""
+
+        if filein in self.active:
+            return
+        if len(self.active) == 0:
+            self.batchstart = time.time()
+        stat = os.stat(filein)
+        self.index.start(os.path.abspath(filein), stat.st_size, stat.st_mtime,
+                         self._output(filein))
+        if self.chunkdur and self.type == ".h264":
+            if self.fps is None:
+                self.fps = 25
+            try:
+                jobs = [(filein,) + job for job in self._split(filein)]
+            except Exception as e:
+                self.index.fail(os.path.abspath(filein), repr(e))
+                lineprint("Failed splitting "+os.path.basename(filein)+": "+\
+                          repr(e), label="pirecorder")
+                return
+            lineprint("Split "+os.path.basename(filein)+" in "+str(len(jobs))+\
+                      " chunks..", label="pirecorder")
+        else:
+            jobs = [(filein, filein, self._output(filein), 0, None)]
+        self.active[filein] = {"jobs": jobs, "left": len(jobs), "duration": 0.,
+                               "error": None, "name": os.path.basename(filein),
+                               "source": os.path.abspath(filein),
+                               "output": self._output(filein),
+                               "chunked": jobs[0][1] != filein}
+        priority = self._priority(filein)
+        for job in jobs:
+            self.queue.put(job, priority)
+
+
+    def submitseq(self, name, files):
+
+        """Queues the conversion of an image sequence"""
+
+        key = os.path.abspath(name)
+        if key in self.active:
+            return
+        if len(self.active) == 0:
+            self.batchstart = time.time()
+        source, size, mtime = self._sequence(name, files)
+        output = self._seqoutput(name)
+        self.index.start(source, size, mtime, output)
+        job = (key, files, output[:-len(".mp4")], 0, None)
+        self.active[key] = {"jobs": [job], "left": 1, "duration": 0.,
+                            "error": None, "name": os.path.basename(name),
+                            "source": source, "output": output,
+                            "chunked": False}
+        self.queue.put(job, self._priority(files))
+
+
+    def collect(self, timeout = None):
+
+        """
+        Handles the results of the conversions as they finish, until all
+        conversions finished or no result arrived within timeout seconds
+        """
+
+        from multiprocess import TimeoutError
+
+        while len(self.active) > 0:
+            self.checkcancel()
+            self.checkrecording()
+            self.checkload()
+            if len(self.active) == 0:
+                break
+            try:
+                job, duration, error, memory = self.results.next(
+                                           1 if timeout is None else timeout)
+            except TimeoutError:
+                if timeout is None:
+                    continue
+                return
+            self.queue.done()
+            self.footprint = max(self.footprint or 0, memory)
+            self._register(job[0], 1, duration, error)
+
+
+    def checkrecording(self):
+
+        """Reduces the number of conversions while a recording is active"""
+
+        if not self.throttle:
+            return
+        throttled = recording(self.lockfile)
+        if throttled == self.throttled:
+            return
+        self.throttled = throttled
+        if throttled:
+            lineprint("Recording active, throttling conversion..",
+                      label="pirecorder")
+        else:
+            lineprint("Recording ended, converting at full speed..",
+                      label="pirecorder")
+        if self.queue is not None:
+            self.queue.setlimit(self._limit())
+
+
+    def _limit(self):
+
+        limit = self.autolimit if self.auto else self.pools
+        if self.throttled:
+            limit = min(limit, self.recpools)
+
+        return limit
+
+
+    def checkload(self, force = False):
+
+        """
+        Adjusts the number of simultaneous conversions in auto mode to the
+        cpu load, available memory, memory use per conversion, and the cpu
+        temperature
+        """
+
+        if not self.auto or (not force and time.time() - self.lastload < 10):
+            return
+        self.lastload = time.time()
+        load = os.getloadavg()[0]
+        memory = memavailable()
+        temp = cputemp()
+        state = throttled()
+        inflight = 0 if self.queue is None else self.queue.inflight
+        waiting = 0 if self.queue is None else len(self.queue)
+
+        limit, reason = self.autolimit, None
+        if force:
+            limit, reason = self.pools - int(round(load)), "start"
+        elif load > self.pools:
+            limit, reason = limit - 1, "high load"
+        elif load < self.pools - 1 and waiting > 0:
+            limit, reason = limit + 1, "idle cores"
+        if (temp is not None and temp >= 80) or \
+           (state is not None and state & 0x6):
+            if limit >= self.autolimit:
+                limit, reason = self.autolimit - 1, "cpu temperature"
+        elif temp is not None and temp >= 75 and limit > self.autolimit:
+            limit, reason = self.autolimit, "cpu temperature"
+        if memory is not None:
+            footprint = self.footprint or _footprint
+            maxlimit = inflight + int(0.8 * memory / footprint)
+            if limit > maxlimit:
+                limit, reason = maxlimit, "memory"
+        limit = max(1, min(limit, self.pools))
+
+        if limit != self.autolimit or force:
+            state = "load "+str(round(load, 1))
+            if memory is not None:
+                state += ", "+str(int(memory))+"MB available"
+            if temp is not None:
+                state += ", "+str(round(temp, 1))+"C"
+            lineprint("Converting "+str(limit)+" file(s) at a time ("+\
+                      reason+"; "+state+")..", label="pirecorder")
+            self.autolimit = limit
+            if self.queue is not None:
+                self.queue.setlimit(self._limit())
+
+
+    def checkcancel(self):
+
+        """Cancels the waiting jobs of videos and sequences with a cancel marker"""
+
+        for filein in list(self.active):
+            if os.path.exists(_marker(filein, self.outdir)):
+                removed = self.queue.remove(lambda job: job[0] == filein)
+                if len(removed) > 0:
+                    self._register(filein, len(removed), 0., "cancelled")
+
+
+    def _register(self, filein, nr, duration, error):
+
+        entry = self.active[filein]
+        entry["left"] -= nr
+        entry["duration"] += duration
+        if error is not None and entry["error"] is None:
+            entry["error"] = error
+            removed = self.queue.remove(lambda job: job[0] == filein)
+            entry["left"] -= len(removed)
+        if entry["left"] > 0:
+            return
+        del self.active[filein]
+        self.finish(filein, entry)
+        if len(self.active) == 0:
+            lineprint("Done converting all videofiles!", label="pirecorder")
+            self.report(self.batchstart)
+
+
+    def finish(self, filein, entry):
+
+        """Completes, cancels, or fails the conversion of a video or sequence"""
+
+        source, name, output = entry["source"], entry["name"], entry["output"]
+        jobs, error = entry["jobs"], entry["error"]
+        if entry["chunked"]:
+            try:
+                if error is None:
+                    self._concat(output, [job[1:3] for job in jobs])
+            except Exception as e:
+                error = repr(e)
+            shutil.rmtree(os.path.dirname(jobs[0][1]), ignore_errors = True)
+        if error is None and (not os.path.isfile(output) or
+                              os.path.getsize(output) == 0):
+            error = "no output written"
+
+        if error is None:
+            self.index.finish(source, entry["duration"])
+            lineprint("Finished converting "+name+" in "+\
+                      str(round(entry["duration"], 1))+"s..", label="pirecorder")
+            if self.delete and self.type not in [".jpg",".jpeg",".png"]:
+                os.remove(filein)
+                idxfile = os.path.splitext(filein)[0]+"_keyframes.idx"
+                if os.path.isfile(idxfile):
+                    os.remove(idxfile)
+                lineprint("Deleted "+name+"..", label="pirecorder")
+        elif error == "cancelled":
+            self.index.cancel(source)
+            if os.path.exists(output):
+                os.remove(output)
+            lineprint("Cancelled converting "+name+"..", label="pirecorder")
+        else:
+            self.index.fail(source, error)
+            lineprint("Failed converting "+name+": "+error, label="pirecorder")
+        marker = _marker(filein, self.outdir)
+        if os.path.exists(marker):
+            os.remove(marker)
+
+
+    def report(self, since):
+
+        """Reports the throughput of the conversions finished since since"""
+
+        stats = self.index.stats(since = since)
+        if stats["files"] > 0:
+            lineprint("Converted "+str(stats["files"])+" file(s), "+\
+                      str(round(stats["mbps"], 1))+" MB/s and "+\
+                      str(round(stats["filesperhour"]))+\
+                      " files/hour per process..", label="pirecorder")
+
+
+    def conv_job(self, job):
+
+        """
+        Converts a video, chunk of a video, or image sequence in a worker
+        process, and returns
+        the job, the conversion time, the error if the conversion failed, and
+        the largest memory use of a conversion by this worker in MB. Chunks
+        are extracted from the video just before they are converted
+        """
+
+        import resource
+
+        source, filein, fileout, offset, span = job
+        start = time.time()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            marker = _marker(source, self.outdir)
+            if isinstance(filein, list):
+                lineprint("Start converting "+str(len(filein))+" images of "+\
+                          os.path.basename(source), label="pirecorder")
+                self._convert_images(filein, fileout, marker)
+            else:
+                if filein == source:
+                    lineprint("Start converting "+os.path.basename(filein),
+                              label="pirecorder")
+                if span is not None:
+                    from .h264index import H264Index
+                    H264Index(source).extract(filein, *span)
+                try:
+                    self._convert(filein, fileout, offset, marker)
+                finally:
+                    if span is not None and os.path.exists(filein):
+                        os.remove(filein)
+            error = None
         except KeyboardInterrupt:
             raise KeyboardInterruptError()
+        except JobCancelled:
+            error = "cancelled"
+        except Exception as e:
+            error = repr(e)
+
+        memory = max(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak)
+
+        return job, time.time() - start, error, memory / 1024.
+
+
+    def _convert(self, filein, fileout, offset = 0, marker = None):
 
+        """
+        Converts filein to the mp4 fileout, numbering frames from offset, and
+        stops with JobCancelled when the file marker is created
+        """
 
-    def convertpool(self):
+        cancelled = lambda: marker is not None and os.path.exists(marker)
+        if cancelled():
+            raise JobCancelled()
 
-        if len(self.todo) > 0:
+        if self.withframe == "opencv":
+            from pythutils.drawutils import draw_text
 
-            if self.type in [".h264",".mp4",".avi"]:
+            vid = cv2.VideoCapture(filein)
+            fps, width, height, _ = get_vid_params(vid)
+            vid.release()
+            vid = cv2.VideoCapture(filein)
+            if self.fps is None:
+                self.fps = fps
+            vidout = videowriter(fileout, width, height, self.fps, self.resizeval)
 
-                pool = Pool(min(self.pools, len(self.todo)))
+            while True:
+                flag, frame = vid.read()
+                if flag:
+                    if self.resizeval != 1:
+                        frame = imgresize(frame, self.resizeval)
+                    frame_nr = int(vid.get(cv2.CAP_PROP_POS_FRAMES)) + offset
+                    draw_text(frame, str(frame_nr), (10,10), 0.9, col="white",
+                              shadow=True)
+                    vidout.write(frame)
+                    if frame_nr % 25 == 0 and cancelled():
+                        break
+                if not flag:
+                    break
+            vid.release()
+            vidout.release()
+            if cancelled():
+                raise JobCancelled()
+
+        else:
+            filters = []
+            if self.resizeval != 1:
+                filters.append("scale=iw*" + str(self.resizeval) + ":-2")
+            if self.withframe:
+                filters.append("drawtext=text=%{frame_num}:start_number=" +\
+                               str(offset + 1) + ":x=15:y=15:fontsize=26:" +\
+                               "fontcolor=white:shadowcolor=black:" +\
+                               "shadowx=2:shadowy=2")
+            throttled = self.throttle and recording(self.lockfile)
+            if len(filters) > 0:
+                comm = "' -vf '" + ",".join(filters) + "' -vcodec libx264" +\
+                       " -crf " + str(self.crf) + " -pix_fmt yuv420p '"
+                if throttled:
+                    comm = comm[:-1] + "-threads 1 '"
+            else:
+                comm = "' -vcodec copy '"
+            bashcomm = "ffmpeg"
+            if self.fps is not None:
+                bashcomm = bashcomm+" -r "+ str(self.fps)
+            bashcomm = bashcomm+" -i '"+filein+comm+fileout+"'"
+            bashcomm = bashcomm + " -y -nostats -loglevel 0"
+            proc = subprocess.Popen(['bash','-c', bashcomm])
+            if throttled:
+                _lowpriority(proc.pid)
+            while True:
                 try:
-                    pool.map(self.conv_single, self.todo)
-                    pool.close()
-                    lineprint("Done converting all videofiles!", label="pirecorder")
-                except KeyboardInterrupt:
-                    lineprint("User terminated converting pool..", label="pirecorder")
-                    self.terminated = True
-                    pool.terminate()
-                    return
-                except Exception as e:
-                    excep = "Got exception: %r, terminating pool" % (e,)
-                    lineprint(excep, label="pirecorder")
-                    pool.terminate()
-                finally:
-                    pool.join()
+                    proc.wait(timeout = 1)
+                    break
+                except subprocess.TimeoutExpired:
+                    if self.throttle and not throttled and \
+                       recording(self.lockfile):
+                        throttled = True
+                        _lowpriority(proc.pid)
+                    if cancelled():
+                        proc.kill()
+                        proc.wait()
+                        raise JobCancelled()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, bashcomm)
 
-                if self.delete:
-                    for filein in self.todo:
-                        os.remove(filein)
-                    lineprint("Deleted all original videofiles..", label="pirecorder")
-
-            elif self.type in [".jpg",".jpeg",".png"]:
-
-                vidname = commonpref(self.todo)
-                lineprint("Start converting "+str(len(self.todo))+" images", label="pirecorder")
-
-                frame_array = []
-                for filename in self.todo:
-                    frame = cv2.imread(filename)
-                    frame_array.append(frame)
-                    #os.rename(filename, self.outdir+"/"+filename)
-                h, w, _ = frame_array[0].shape
-                if self.outdir != "":
-                    vidname = self.outdir+"/"+os.path.basename(vidname)
-                vidout = videowriter(vidname, w, h, self.imgfps, self.resizeval)
-                for i in range(len(frame_array)):
-                    vidout.write(frame_array[i])
+
+    def _split(self, filein):
+
+        """
+        Splits a raw h264 file losslessly at keyframes into chunks of about
+        chunkdur seconds, and returns the conversion job of each chunk with
+        the number of frames that precede it and its byte range, from which
+        the worker extracts the chunk
+        """
+
+        from .h264index import H264Index
+
+        chunkdir = self.outdir+"/.chunks_"+os.path.basename(filein)
+        os.makedirs(chunkdir, exist_ok = True)
+        index = H264Index(filein)
+        jobs = []
+        for i, (frame, start, end) in enumerate(index.chunks(self.chunkdur*self.fps)):
+            chunk = chunkdir+"/chunk_%05d.h264" % i
+            jobs.append((chunk, chunk[:-len(".h264")]+".mp4", frame,
+                         (start, end)))
+        if len(jobs) == 0:
+            raise ValueError("No keyframes found in "+filein)
+
+        return jobs
+
+
+    def _concat(self, fileout, jobs):
+
+        """Concatenates the converted chunks losslessly into fileout"""
+
+        chunkdir = os.path.dirname(jobs[0][0])
+        listfile = chunkdir+"/concat.txt"
+        with open(listfile, "w") as f:
+            for _, chunkout in jobs:
+                f.write("file '"+os.path.abspath(chunkout)+"'\n")
+        bashcomm = "ffmpeg -f concat -safe 0 -i '"+listfile+"' -c copy '"+\
+                   fileout+"' -y -nostats -loglevel 0"
+        subprocess.check_output(['bash','-c', bashcomm])
+
+
+    def _convert_images(self, files, vidname, marker = None):
+
+        """
+        Converts an image sequence to the video vidname, one frame at a time,
+        and stops with JobCancelled when the file marker is created
+        """
+
+        vidout, dims = None, None
+        workers = self.imgthreads
+        if self.throttle and recording(self.lockfile):
+            workers = min(workers, self.recpools)
+        frames = decodeframes(files, self.resizeval, workers, self.readahead)
+        try:
+            for i, (filename, frame) in enumerate(frames):
+                if frame is None:
+                    lineprint("Could not read "+filename+", skipping..", label="pirecorder")
+                    continue
+                if vidout is None:
+                    h, w = frame.shape[:2]
+                    dims = (w, h)
+                    vidout = videowriter(vidname, w, h, self.imgfps)
+                if frame.shape[1::-1] != dims:
+                    frame = imgresize(frame, dims = dims)
+                vidout.write(frame)
+                if i % 25 == 0 and marker is not None and os.path.exists(marker):
+                    raise JobCancelled()
+        finally:
+            frames.close()
+            if vidout is not None:
                 vidout.release()
-                lineprint("Finished converting "+os.path.basename(vidname), label="pirecorder")
+        if vidout is None:
+            raise ValueError("no readable images")
 
-            else:
-                lineprint("No video or image files found..", label="pirecorder")
+
+    def convertpool(self, wait = True):
+
+        """
+        Converts the files or image sequences in todo. These are queued in
+        the worker pool and, if wait is True, this waits until all queued
+        videos and sequences are converted.
+        """
+
+        if self.type in [".h264",".mp4",".avi",".jpg",".jpeg",".png"]:
+
+            if len(self.todo) == 0 and len(self.active) == 0:
+                return
+            try:
+                self.startpool()
+                if self.type in [".jpg",".jpeg",".png"]:
+                    if len(self.todo) > 0:
+                        lineprint("Found "+str(len(self.todo))+" image "+\
+                                  "sequence(s)..", label="pirecorder")
+                        self.imgthreads = max(1, self.pools //
+                                              min(self._limit(), len(self.todo)))
+                    for name, files in sorted(self.todo, key = lambda s:
+                                              self._priority(s[1])):
+                        self.submitseq(name, files)
+                else:
+                    for filein in sorted(self.todo, key = self._priority):
+                        self.submit(filein)
+                self.collect(None if wait else 0)
+            except KeyboardInterrupt:
+                lineprint("User terminated converting pool..", label="pirecorder")
+                self.terminated = True
+                self.stoppool()
+
+        elif len(self.todo) > 0:
+            lineprint("No video or image files found..", label="pirecorder")
 
 
 def conv():
@@ -226,15 +1014,26 @@ def conv():
     parser.add_argument("-t", "--type", default=".h264", metavar="")
     parser.add_argument("-w", "--withframe", default="False", metavar="")
     parser.add_argument("-d", "--delete", default="False", metavar="")
-    parser.add_argument("-p", "--pools", default=4, type=int, metavar="")
+    parser.add_argument("-p", "--pools", default="4", metavar="")
     parser.add_argument("-r", "--resizeval", default=1, type=float, metavar="")
     parser.add_argument("-f", "--imgfps", default=25, type=int, metavar="")
     parser.add_argument("-s", "--sleeptime", default=None, type=int, metavar="")
+    parser.add_argument("-n", "--chunkdur", default=None, type=float, metavar="")
+    parser.add_argument("-c", "--crf", default=23, type=int, metavar="")
+    parser.add_argument("-q", "--priority", default=None, metavar="")
+    parser.add_argument("-a", "--throttle", default="False", metavar="")
+    parser.add_argument("-l", "--recpools", default=1, type=int, metavar="")
 
     args = parser.parse_args()
-    args.withframe = ast.literal_eval(args.withframe)
+    if args.withframe != "opencv":
+        args.withframe = ast.literal_eval(args.withframe)
     args.delete = ast.literal_eval(args.delete)
+    args.throttle = ast.literal_eval(args.throttle)
+    if args.pools != "auto":
+        args.pools = int(args.pools)
     Convert(indir = args.indir, outdir = args.outdir, type = args.type,
             withframe = args.withframe, delete = args.delete, pools = args.pools,
             resizeval = args.resizeval, imgfps = args.imgfps,
-            sleeptime = args.sleeptime)
+            sleeptime = args.sleeptime, chunkdur = args.chunkdur,
+            crf = args.crf, priority = args.priority,
+            throttle = args.throttle, recpools = args.recpools)
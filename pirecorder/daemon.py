@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import socket
+import argparse
+from time import monotonic
+
+from pythutils.sysutils import lineprint, homedir
+
+def _socketfile(socketfile = None):
+
+    if socketfile is None:
+        socketfile = homedir() + "pirecorder/recorder.sock"
+
+    return socketfile
+
+
+def request(command = "record", configfile = "pirecorder.conf",
+            socketfile = None, timeout = None):
+
+    """
+    Sends a request to a running recorder daemon and returns its response
+
+    Parameters
+    ----------
+    command : ["record", "ping", "stop"], default = "record"
+        Start a recording with the provided configuration file, check if the
+        daemon is running, or stop the daemon.
+    configfile : str, default = "pirecorder.conf"
+        The name of the configuration file to be used for the recording.
+    socketfile : str, default = None
+        The unix socket the daemon listens on. By default the recorder.sock
+        file in the pirecorder folder.
+    timeout : float, default = None
+        Maximum time in seconds to wait for the response, by default waits
+        until the requested recording has finished.
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(_socketfile(socketfile))
+    message = {"command": command, "configfile": configfile}
+    sock.sendall((json.dumps(message)+"\n").encode())
+    with sock.makefile("r") as f:
+        response = json.loads(f.readline())
+    sock.close()
+
+    return response
+
+
+def record(configfile = "pirecorder.conf", socketfile = None):
+
+    """
+    Starts a recording with the recorder daemon, or directly when the daemon
+    is not running, such that a scheduled recording is never lost
+
+    Parameters
+    ----------
+    configfile : str, default = "pirecorder.conf"
+        The name of the configuration file to be used for the recording.
+    socketfile : str, default = None
+        The unix socket the daemon listens on. By default the recorder.sock
+        file in the pirecorder folder.
+    """
+
+    try:
+        return request("record", configfile, socketfile)
+    except (ConnectionRefusedError, FileNotFoundError):
+        lineprint("Recorder daemon not running, recording directly..")
+
+    from .pirecorder import PiRecorder
+
+    PiRecorder(configfile).record()
+
+
+class Daemon:
+
+    """
+    Long-lived recorder service that keeps the camera open and settled, and
+    starts recordings on request over a local unix socket. This avoids the
+    start up time of a new interpreter, the camera set up and warm up, and the
+    flicker fix for each recording, such that a recording starts directly
+    when requested. The camera is only set up again when a request uses a
+    configuration with different camera settings. Requests can be sent with
+    the request() function, or scheduled with the daemon option of the
+    schedule function.
+
+    Parameters
+    ----------
+    configfile : str, default = "pirecorder.conf"
+        The name of the configuration file used to set up the camera.
+    socketfile : str, default = None
+        The unix socket to listen on. By default the recorder.sock file in the
+        pirecorder folder.
+    """
+
+    def __init__(self, configfile = "pirecorder.conf", socketfile = None):
+
+        from .pirecorder import PiRecorder
+
+        self.rec = PiRecorder(configfile)
+        if not hasattr(self.rec, "config"):
+            return
+        self.rec.settings(internal = True)
+        self._setup_cam(self.rec)
+        self.socketfile = _socketfile(socketfile)
+
+        self.serve()
+
+
+    def _setup_cam(self, rec):
+
+        """Sets up the camera and readies the encoder for video recordings"""
+
+        rec._setup_cam()
+        if rec.config.rec.rectype not in ["img","imgseq","rawseq"]:
+            rec._flickerfix()
+
+
+    def _load(self, configfile):
+
+        """Loads the configuration and reuses the camera if possible"""
+
+        from .pirecorder import PiRecorder
+
+        rec = PiRecorder(configfile, logging = False)
+        rec.settings(internal = True)
+        if rec._camsettings() == self.rec.camsettings and \
+           not self.rec.cam.closed:
+            for attr in ["cam", "resize", "longexpo", "rawCapture",
+                         "flickerfixed", "camsettings", "camtimes"]:
+                setattr(rec, attr, getattr(self.rec, attr))
+        else:
+            lineprint("Camera settings changed, setting up camera..")
+            self.rec.cam.close()
+            self._setup_cam(rec)
+        self.rec = rec
+
+
+    def handle(self, message):
+
+        """Handles a single request and returns the response"""
+
+        received = monotonic()
+        command = message.get("command", "record")
+        if command == "ping":
+            return {"status": "ok"}
+        if command == "stop":
+            self.stopped = True
+            return {"status": "stopped"}
+        if command != "record":
+            return {"status": "error", "error": "unknown command "+command}
+
+        self._load(message.get("configfile", self.rec.configfilerel))
+        latency = monotonic() - received
+        lineprint("Recording request received, starting after "+\
+                  str(round(latency*1000, 1))+"ms..")
+        self.rec.record(keepcam = True)
+
+        return {"status": "ok", "latency": latency,
+                "duration": monotonic() - received}
+
+
+    def serve(self):
+
+        """Listens for requests until a stop request or keyboard interrupt"""
+
+        if os.path.exists(self.socketfile):
+            os.remove(self.socketfile)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socketfile)
+        server.listen(5)
+        lineprint("Recorder daemon listening on "+self.socketfile+"..")
+
+        self.stopped = False
+        try:
+            while not self.stopped:
+                conn, _ = server.accept()
+                with conn, conn.makefile("rw") as f:
+                    try:
+                        response = self.handle(json.loads(f.readline()))
+                    except Exception as e:
+                        lineprint("Request failed: "+str(e))
+                        response = {"status": "error", "error": str(e)}
+                    f.write(json.dumps(response)+"\n")
+                    f.flush()
+        except KeyboardInterrupt:
+            lineprint("User terminated recorder daemon..")
+        finally:
+            server.close()
+            os.remove(self.socketfile)
+            self.rec.cam.close()
+            lineprint("Recorder daemon stopped..")
+
+
+def recd():
+
+    """To run the recorder daemon from the command line"""
+
+    parser = argparse.ArgumentParser(prog="recorderd",
+             description=Daemon.__doc__,
+             formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-c", "--configfile", default="pirecorder.conf",
+                        metavar="")
+    parser.add_argument("-s", "--socketfile", default=None, metavar="")
+
+    args = parser.parse_args()
+    Daemon(configfile = args.configfile, socketfile = args.socketfile)
@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import mmap
+import struct
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_right
+
+_magic = b"PIRIDX01"
+_header = "<8sQqQQQQ"
+
+def scan(filename):
+
+    """
+    Scans a raw (Annex-B) h264 file for NAL units and returns the number of
+    frames, the frame number and byte offset of each keyframe (IDR frame,
+    including the parameter sets that precede it), and the offset and length
+    of the first sequence and picture parameter sets
+    """
+
+    frames, keyframes = 0, []
+    hdroff, hdrlen = 0, 0
+    if os.path.getsize(filename) == 0:
+        return frames, keyframes, (hdroff, hdrlen)
+
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            size = len(mm)
+            pending, sps = None, None
+            pos = mm.find(b"\x00\x00\x01")
+            while pos != -1 and pos + 4 < size:
+                start = pos - 1 if pos > 0 and mm[pos-1] == 0 else pos
+                nal = mm[pos+3] & 0x1f
+                if nal in [6, 7, 8, 9]:
+                    if pending is None:
+                        pending = start
+                    if nal == 7 and sps is None:
+                        sps = start
+                elif nal in [1, 5]:
+                    if sps is not None and hdrlen == 0:
+                        hdroff, hdrlen = sps, start - sps
+                    if mm[pos+4] & 0x80:
+                        if nal == 5:
+                            keyframes.append((frames, start if pending is None
+                                              else pending))
+                        frames += 1
+                    pending = None
+                pos = mm.find(b"\x00\x00\x01", pos + 3)
+        finally:
+            mm.close()
+
+    return frames, keyframes, (hdroff, hdrlen)
+
+
+class H264Index:
+
+    """
+    Keyframe index of a raw h264 recording, which makes it possible to seek
+    to any frame by decoding only from the keyframe that precedes it, and to
+    split a recording losslessly at keyframes. The stream is scanned once
+    with a memory-mapped read, and the index is stored in a compact sidecar
+    file next to the recording ("_keyframes.idx" replacing the extension),
+    which is used as long as the recording does not change.
+
+    Parameters
+    ----------
+    filename : str
+        The raw h264 file.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.indexfile = os.path.splitext(filename)[0]+"_keyframes.idx"
+        stat = os.stat(filename)
+        self.stamp = (stat.st_size, stat.st_mtime_ns)
+        if not self._load():
+            self.frames, self.keyframes, self.headers = scan(filename)
+            self._store()
+
+
+    def _load(self):
+
+        if not os.path.isfile(self.indexfile):
+            return False
+        with open(self.indexfile, "rb") as f:
+            data = f.read()
+        size = struct.calcsize(_header)
+        if len(data) < size:
+            return False
+        magic, srcsize, mtime, frames, nr, hdroff, hdrlen = \
+            struct.unpack_from(_header, data)
+        if magic != _magic or (srcsize, mtime) != self.stamp:
+            return False
+        values = array("Q")
+        values.frombytes(data[size:size+16*nr])
+        self.frames = frames
+        self.keyframes = list(zip(values[:nr], values[nr:]))
+        self.headers = (hdroff, hdrlen)
+
+        return True
+
+
+    def _store(self):
+
+        header = struct.pack(_header, _magic, self.stamp[0], self.stamp[1],
+                             self.frames, len(self.keyframes), *self.headers)
+        values = array("Q", [k[0] for k in self.keyframes] +
+                            [k[1] for k in self.keyframes])
+        try:
+            with open(self.indexfile, "wb") as f:
+                f.write(header + values.tobytes())
+        except (IOError, OSError):
+            pass
+
+
+    def keyframe(self, frame):
+
+        """Returns the position in keyframes of the last keyframe <= frame"""
+
+        return max(0, bisect_right([k[0] for k in self.keyframes], frame) - 1)
+
+
+    def chunks(self, minframes):
+
+        """
+        Returns the first frame, start and end byte offset of chunks of at
+        least minframes frames that each start at a keyframe
+        """
+
+        chunks = []
+        for frame, offset in self.keyframes:
+            if len(chunks) == 0 or frame - chunks[-1][0] >= minframes:
+                if len(chunks) > 0:
+                    chunks[-1][2] = offset
+                chunks.append([frame, offset, None])
+        if len(chunks) > 0:
+            chunks[-1][2] = os.path.getsize(self.filename)
+
+        return [tuple(chunk) for chunk in chunks]
+
+
+    def extract(self, fileout, start, end):
+
+        """
+        Writes the stream between the byte offsets start and end to fileout,
+        preceded by the parameter sets if the chunk does not contain them
+        """
+
+        with open(self.filename, "rb") as f, open(fileout, "wb") as out:
+            hdroff, hdrlen = self.headers
+            f.seek(start)
+            first = f.read(5)
+            nal = first[3] if first[2] == 1 else first[4]
+            if hdrlen > 0 and nal & 0x1f not in [7, 9]:
+                f.seek(hdroff)
+                out.write(f.read(hdrlen))
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(remaining, 1 << 24))
+                if len(data) == 0:
+                    break
+                out.write(data)
+                remaining -= len(data)
+
+
+    def decode(self, frame, count = 1):
+
+        """
+        Returns count decoded frames starting at frame number frame (zero
+        based), decoding only from the preceding keyframe
+        """
+
+        import cv2
+
+        if len(self.keyframes) == 0 or not 0 <= frame < self.frames:
+            return []
+        i = self.keyframe(frame)
+        j = self.keyframe(frame + count - 1) + 1
+        start = self.keyframes[i][1]
+        end = self.keyframes[j][1] if j < len(self.keyframes) else \
+              os.path.getsize(self.filename)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            chunk = os.path.join(tmpdir, "chunk.h264")
+            self.extract(chunk, start, end)
+            vid = cv2.VideoCapture(chunk)
+            images = []
+            for n in range(self.keyframes[i][0], frame + count):
+                flag, image = vid.read()
+                if not flag:
+                    break
+                if n >= frame:
+                    images.append(image)
+            vid.release()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        return images
@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sqlite3
+from time import time
+
+_schema = """CREATE TABLE IF NOT EXISTS conversions (
+                 source TEXT PRIMARY KEY,
+                 size INTEGER,
+                 mtime REAL,
+                 output TEXT,
+                 status TEXT,
+                 started REAL,
+                 duration REAL,
+                 outsize INTEGER,
+                 error TEXT)"""
+
+class ConvIndex:
+
+    """
+    Persistent index of the conversions in a directory, stored in a small
+    SQLite database. For each source file it records the size and modification
+    time, the output file, the status ("running", "done", "failed" or
+    "cancelled"), and the conversion time, such that finished files can be
+    skipped with a single lookup, interrupted or corrupted conversions are
+    detected and redone, and the conversion throughput can be reviewed.
+
+    Parameters
+    ----------
+    outdir : str
+        The directory with the converted files, where the index is stored.
+    """
+
+    filename = ".pirecorder_convert.db"
+
+    def __init__(self, outdir):
+
+        self.dbfile = os.path.join(outdir, self.filename)
+        self.db = None
+
+
+    def _connect(self):
+
+        if self.db is None:
+            self.db = sqlite3.connect(self.dbfile, timeout = 30)
+            self.db.execute(_schema)
+            self.db.commit()
+
+        return self.db
+
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state["db"] = None
+
+        return state
+
+
+    def get(self, source):
+
+        """Returns the record of a source file as a dictionary, or None"""
+
+        cursor = self._connect().execute("SELECT * FROM conversions WHERE "+\
+                                         "source = ?", (source,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        return dict(zip([c[0] for c in cursor.description], row))
+
+
+    def done(self, source, size, mtime):
+
+        """
+        Returns if the source file with the provided size and modification
+        time was converted, and the output still exists with the same size.
+        Returns None if the source file is not in the index.
+        """
+
+        record = self.get(source)
+        if record is None:
+            return None
+        if record["status"] != "done" or record["size"] != size or \
+           record["mtime"] != mtime:
+            return False
+        output = record["output"]
+
+        return os.path.isfile(output) and os.path.getsize(output) == record["outsize"]
+
+
+    def start(self, source, size, mtime, output):
+
+        """Registers the start of a conversion"""
+
+        db = self._connect()
+        db.execute("INSERT OR REPLACE INTO conversions (source, size, mtime, "+\
+                   "output, status, started) VALUES (?, ?, ?, ?, ?, ?)",
+                   (source, size, mtime, output, "running", time()))
+        db.commit()
+
+
+    def finish(self, source, duration = None):
+
+        """
+        Registers a successful conversion with the size of its output, and
+        the conversion time, by default the time since the start. A
+        conversion without output is registered as failed
+        """
+
+        record = self.get(source)
+        if not os.path.isfile(record["output"]):
+            self.fail(source, "no output written")
+            return
+        if duration is None:
+            duration = time() - record["started"]
+        db = self._connect()
+        db.execute("UPDATE conversions SET status = ?, duration = ?, "+\
+                   "outsize = ?, error = NULL WHERE source = ?",
+                   ("done", duration, os.path.getsize(record["output"]), source))
+        db.commit()
+
+
+    def fail(self, source, error):
+
+        """Registers a failed conversion"""
+
+        db = self._connect()
+        db.execute("UPDATE conversions SET status = ?, error = ? WHERE "+\
+                   "source = ?", ("failed", str(error), source))
+        db.commit()
+
+
+    def cancel(self, source):
+
+        """Registers a cancelled conversion"""
+
+        db = self._connect()
+        db.execute("UPDATE conversions SET status = ? WHERE source = ?",
+                   ("cancelled", source))
+        db.commit()
+
+
+    def stats(self, since = 0):
+
+        """
+        Returns the number of files, bytes, and total conversion time of the
+        conversions finished since the provided time, and the throughput in
+        MB/s and files per hour
+        """
+
+        row = self._connect().execute("SELECT COUNT(*), SUM(size), "+\
+              "SUM(duration) FROM conversions WHERE status = 'done' AND "+\
+              "started >= ?", (since,)).fetchone()
+        files, size, duration = row[0], row[1] or 0, row[2] or 0.
+        stats = {"files": files,
+                 "bytes": size,
+                 "duration": duration,
+                 "mbps": size / 1e6 / duration if duration > 0 else 0.,
+                 "filesperhour": files * 3600. / duration if duration > 0 else 0.}
+
+        return stats
+
+
+    def close(self):
+
+        if self.db is not None:
+            self.db.close()
+            self.db = None
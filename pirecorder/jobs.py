@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import heapq
+import threading
+from itertools import count
+
+class JobQueue:
+
+    """
+    Priority queue of jobs that feeds a worker pool, e.g. by passing it to
+    pool.imap_unordered. Iterating over the queue hands out the job with the
+    lowest priority value (first come, first served for equal priorities),
+    but only while fewer than limit jobs are in progress, such that jobs that
+    are added later can still overtake the jobs that are waiting. Iteration
+    blocks until a job can be handed out and ends when the queue is closed.
+
+    Parameters
+    ----------
+    limit : int
+        Maximum number of jobs in progress.
+    """
+
+    def __init__(self, limit):
+
+        self.limit = limit
+        self.heap = []
+        self.counter = count()
+        self.inflight = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+
+    def __iter__(self):
+
+        while True:
+            with self.cond:
+                while not self.closed and (len(self.heap) == 0 or
+                                           self.inflight >= self.limit):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                _, _, job = heapq.heappop(self.heap)
+                self.inflight += 1
+            yield job
+
+
+    def __len__(self):
+
+        with self.cond:
+            return len(self.heap)
+
+
+    def put(self, job, priority = 0):
+
+        """Adds a job to the queue"""
+
+        with self.cond:
+            heapq.heappush(self.heap, (priority, next(self.counter), job))
+            self.cond.notify_all()
+
+
+    def done(self):
+
+        """Registers that a job that was handed out has finished"""
+
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+
+    def remove(self, match):
+
+        """Removes the waiting jobs for which match(job) is True"""
+
+        with self.cond:
+            removed = [item[2] for item in self.heap if match(item[2])]
+            self.heap = [item for item in self.heap if not match(item[2])]
+            heapq.heapify(self.heap)
+
+        return removed
+
+
+    def setlimit(self, limit):
+
+        """Changes the maximum number of jobs in progress"""
+
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+
+    def close(self):
+
+        """Stops handing out jobs and ends the iteration"""
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
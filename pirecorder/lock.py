@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import fcntl
+
+from pythutils.sysutils import homedir
+
+def _lockfile(lockfile = None):
+
+    if lockfile is None:
+        lockfile = homedir() + "pirecorder/recording.lock"
+
+    return lockfile
+
+
+class RecordingLock:
+
+    """
+    Marks a recording as active for other processes, such as the offload and
+    conversion pipelines, so that they can pause their disk I/O while the
+    camera records. Each recording holds a shared lock on the lock file, which
+    the operating system releases when the recording process ends, such that
+    no stale locks remain after a crash.
+
+    Parameters
+    ----------
+    lockfile : str, default = None
+        The lock file to use. By default the recording.lock file in the
+        pirecorder folder.
+    """
+
+    def __init__(self, lockfile = None):
+
+        self.lockfile = _lockfile(lockfile)
+        self.fd = None
+
+
+    def __enter__(self):
+
+        self.fd = os.open(self.lockfile, os.O_RDONLY | os.O_CREAT)
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def recording(lockfile = None):
+
+    """Returns if a recording is active"""
+
+    lockfile = _lockfile(lockfile)
+    if not os.path.exists(lockfile):
+        return False
+    fd = os.open(lockfile, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+    return False
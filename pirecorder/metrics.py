@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+from glob import glob, escape
+from time import time, monotonic
+
+from .timer import intervalstats
+
+def cputemp():
+
+    """Returns the cpu temperature in degrees Celsius, or None if unknown"""
+
+    try:
+        with open("/sys/class/thermal/thermal_zone0/temp") as f:
+            return int(f.read()) / 1000.
+    except (IOError, ValueError):
+        return None
+
+
+def memavailable():
+
+    """Returns the memory available for new processes in MB, or None if unknown"""
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, ValueError):
+        pass
+
+    return None
+
+
+def throttled():
+
+    """
+    Returns the throttle state reported by the raspberry pi firmware, or None
+    if unknown. Bits 0-3 flag current under-voltage, frequency capping,
+    throttling and soft temperature limit, and bits 16-19 flag if these
+    occurred since boot.
+    """
+
+    import subprocess
+
+    try:
+        out = subprocess.check_output(["vcgencmd", "get_throttled"])
+        return int(out.decode().strip().split("=")[1], 16)
+    except (OSError, subprocess.CalledProcessError, IndexError, ValueError):
+        return None
+
+
+class Metrics:
+
+    """
+    Collects the performance metrics of a single recording and stores them as
+    a json line and optionally as a Prometheus textfile, such that the
+    performance of many raspberry pis can be monitored and compared.
+
+    Parameters
+    ----------
+    labels : keyword arguments
+        Values that identify the recording, e.g. host, label, and rectype.
+    """
+
+    def __init__(self, **labels):
+
+        self.labels = labels
+        self.values = {}
+        self.start = monotonic()
+        self.date = time()
+        self.frametimes = []
+        self.latencies = []
+
+
+    def set(self, **values):
+
+        """Sets one or more metrics"""
+
+        self.values.update(values)
+
+
+    def add(self, **values):
+
+        """Adds to one or more metrics"""
+
+        for key, value in values.items():
+            self.values[key] = self.values.get(key, 0) + value
+
+
+    def frame(self, t = None):
+
+        """Registers the monotonic time a frame was captured"""
+
+        self.frametimes.append(monotonic() if t is None else t)
+
+
+    def collect(self, prefix = None):
+
+        """
+        Completes the metrics with the time to first frame, achieved fps,
+        write latency percentiles, bytes written to files starting with prefix
+        since the start, and the cpu temperature and throttle state
+        """
+
+        if len(self.frametimes) > 0:
+            self.values.setdefault("firstframe", self.frametimes[0]-self.start)
+            self.values.setdefault("frames", len(self.frametimes))
+            self.values.setdefault("fps", intervalstats(self.frametimes)["fps"])
+        if len(self.latencies) > 0:
+            latencies = sorted(self.latencies)
+            n = len(latencies)
+            self.values["writelatency_p50"] = latencies[int(0.5*n)]
+            self.values["writelatency_p95"] = latencies[min(n-1, int(0.95*n))]
+            self.values["writelatency_max"] = latencies[-1]
+        if prefix is not None:
+            files = [f for f in glob(escape(prefix)+"*")
+                     if os.path.getmtime(f) >= self.date - 1]
+            self.values["bytes"] = sum(os.path.getsize(f) for f in files)
+        self.values["duration"] = monotonic() - self.start
+        self.values["cputemp"] = cputemp()
+        self.values["throttled"] = throttled()
+
+        return self.values
+
+
+    def write(self, jsonfile, promfile = None):
+
+        """Appends the metrics to jsonfile and stores them in promfile"""
+
+        record = dict(self.labels, date = self.date, **self.values)
+        with open(jsonfile, "a") as f:
+            f.write(json.dumps(record, sort_keys = True)+"\n")
+
+        if promfile:
+            labels = ",".join(k+"=\""+str(v)+"\"" for k, v in
+                              sorted(self.labels.items()))
+            lines = []
+            for key, value in sorted(self.values.items()):
+                if isinstance(value, bool) or \
+                   not isinstance(value, (int, float)):
+                    continue
+                lines.append("# TYPE pirecorder_"+key+" gauge")
+                lines.append("pirecorder_"+key+"{"+labels+"} "+repr(value))
+            tmpfile = promfile + ".tmp"
+            with open(tmpfile, "w") as f:
+                f.write("\n".join(lines)+"\n")
+            os.replace(tmpfile, promfile)
+
@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from time import monotonic
+from collections import deque
+
+from pythutils.sysutils import lineprint
+
+class MotionDetector:
+
+    """
+    Custom picamera output that detects activity in a low resolution yuv video
+    stream with vectorized frame differencing of the grayscale (Y) plane. As
+    the camera zoom applies to all ports, the analysed stream covers the
+    configured roi only.
+
+    Parameters
+    ----------
+    size : tuple, default = (160, 120)
+        Resolution of the yuv stream that is analysed.
+    threshold : float, default = 0.005
+        Minimum fraction of pixels that changed between subsequent analysed
+        frames for the frame to count as activity.
+    pixdiff : int, default = 25
+        Minimum difference in grey level for a pixel to count as changed.
+    wait : float, default = 5
+        Time in seconds that activity is considered ongoing after it was last
+        detected.
+    framerate : float, default = 10
+        Framerate of the analysed stream, used to compute the analysis cost
+        relative to the time available per frame.
+    budget : float, default = 0.1
+        Maximum share of a single core the analysis may use. When exceeded,
+        frames are skipped such that only every nth frame is analysed.
+    """
+
+    def __init__(self, size = (160,120), threshold = 0.005, pixdiff = 25,
+                 wait = 5, framerate = 10, budget = 0.1):
+
+        self.w, self.h = size
+        self.fw = (self.w + 31) // 32 * 32
+        self.fh = (self.h + 15) // 16 * 16
+        self.threshold = threshold
+        self.pixdiff = pixdiff
+        self.wait = wait
+        self.interval = 1. / float(framerate)
+        self.budget = budget
+
+        self.prev = None
+        self.frames = 0
+        self.nth = 1
+        self.analysed = 0
+        self.totalcost = 0.
+        self.maxcost = 0.
+        self.recent = deque(maxlen = 25)
+        self.activity = 0.
+        self.lastmotion = None
+
+
+    def write(self, buf):
+
+        self.frames += 1
+        if self.frames % self.nth != 0:
+            return len(buf)
+
+        start = monotonic()
+        img = np.frombuffer(buf, dtype = np.uint8, count = self.fw * self.fh)
+        img = img.reshape((self.fh, self.fw))[:self.h, :self.w].astype(np.int16)
+        if self.prev is not None:
+            changed = np.abs(img - self.prev) > self.pixdiff
+            self.activity = np.count_nonzero(changed) / float(changed.size)
+            if self.activity >= self.threshold:
+                self.lastmotion = monotonic()
+        self.prev = img
+
+        cost = monotonic() - start
+        self.analysed += 1
+        self.totalcost += cost
+        self.maxcost = max(self.maxcost, cost)
+        self.recent.append(cost)
+        if self.analysed % self.recent.maxlen == 0:
+            meancost = sum(self.recent) / len(self.recent)
+            if meancost > self.budget * self.interval * self.nth:
+                self.nth += 1
+
+        return len(buf)
+
+
+    def flush(self):
+
+        pass
+
+
+    def active(self):
+
+        """Returns if activity was detected within the last wait seconds"""
+
+        if self.lastmotion is None:
+            return False
+
+        return monotonic() - self.lastmotion < self.wait
+
+
+    def stats(self):
+
+        """Returns the analysis cost per frame and share of a single core"""
+
+        meancost = self.totalcost / max(1, self.analysed)
+        stats = {"frames": self.frames,
+                 "analysed": self.analysed,
+                 "nth": self.nth,
+                 "meancost": meancost,
+                 "maxcost": self.maxcost,
+                 "coreshare": meancost / (self.interval * self.nth)}
+        lineprint("Motion analysis: "+str(round(meancost*1000, 2))+\
+                  "ms per frame, "+str(round(stats["coreshare"]*100, 1))+\
+                  "% of a core, analysing every "+str(self.nth)+" frame(s)..")
+
+        return stats
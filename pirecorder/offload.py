@@ -0,0 +1,440 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import socket
+import hashlib
+import argparse
+from time import time, sleep, monotonic
+
+from pythutils.sysutils import lineprint, homedir
+
+from .lock import recording
+
+class _DirTarget:
+
+    """Offload target that is a (mounted) directory"""
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok = True)
+
+
+    def _path(self, rel):
+
+        if os.path.isabs(rel) or ".." in rel.replace("\\", "/").split("/"):
+            raise ValueError("Invalid path "+rel)
+        path = os.path.join(self.directory, rel)
+        base = os.path.realpath(self.directory)
+        if os.path.commonpath([os.path.realpath(path), base]) != base:
+            raise ValueError("Invalid path "+rel)
+
+        return path
+
+
+    def offset(self, rel):
+
+        """Returns the number of bytes of the file that were transferred"""
+
+        partial = self._path(rel) + ".partial"
+
+        return os.path.getsize(partial) if os.path.exists(partial) else 0
+
+
+    def write(self, rel, offset, data):
+
+        """Writes data at offset, truncating the file when offset is 0"""
+
+        partial = self._path(rel) + ".partial"
+        os.makedirs(os.path.dirname(partial), exist_ok = True)
+        with open(partial, "wb" if offset == 0 else "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+
+
+    def finish(self, rel, checksum):
+
+        """Verifies the transferred file and moves it into place"""
+
+        partial = self._path(rel) + ".partial"
+        sha = hashlib.sha256()
+        with open(partial, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+            os.fsync(f.fileno())
+        if sha.hexdigest() != checksum:
+            os.remove(partial)
+            return False
+        os.replace(partial, self._path(rel))
+
+        return True
+
+
+    def close(self):
+
+        pass
+
+
+class _TCPTarget:
+
+    """Offload target that is an OffloadServer listening on host:port"""
+
+    def __init__(self, host, port):
+
+        self.sock = socket.create_connection((host, port))
+        self.f = self.sock.makefile("rb")
+
+
+    def _request(self, message, data = b""):
+
+        self.sock.sendall((json.dumps(message)+"\n").encode() + data)
+        response = json.loads(self.f.readline())
+        if response["status"] != "ok":
+            raise IOError(response.get("error", "offload server error"))
+
+        return response
+
+
+    def offset(self, rel):
+
+        return self._request({"command": "offset", "path": rel})["offset"]
+
+
+    def write(self, rel, offset, data):
+
+        self._request({"command": "write", "path": rel, "offset": offset,
+                       "size": len(data)}, data)
+
+
+    def finish(self, rel, checksum):
+
+        message = {"command": "finish", "path": rel, "checksum": checksum}
+
+        return self._request(message)["verified"]
+
+
+    def close(self):
+
+        self.f.close()
+        self.sock.close()
+
+
+def _target(target):
+
+    """Returns the offload target for a directory or host:port string"""
+
+    host, _, port = target.rpartition(":")
+    if host != "" and port.isdigit() and not os.path.isdir(target):
+        return _TCPTarget(host, int(port))
+    if not os.path.isabs(target):
+        target = homedir() + target
+
+    return _DirTarget(target)
+
+
+class Offload:
+
+    """
+    Moves finished recordings from local storage to a remote target in the
+    background. Recording directly to a network mount causes stalls that the
+    h264 encoder cannot absorb, so recordings are best stored on local
+    storage and moved afterwards. Files are transferred in chunks that are
+    resumed after an interruption, with an optional bandwidth cap, and are
+    only removed locally once the checksum of the transferred file has been
+    verified. Transfers pause while a recording is active, such that they
+    never compete with the camera for I/O.
+
+    Parameters
+    ----------
+    source : str, default = "pirecorder/recordings"
+        The local directory with recordings, relative to the home directory.
+        Files in subdirectories are offloaded with the same subdirectory.
+    target : str, default = "NAS"
+        The target to move recordings to, either a directory (relative to the
+        home directory, e.g. a mounted network drive) or the host:port of an
+        OffloadServer.
+    wait : float, default = 60
+        Minimum time in seconds since a file was last modified for it to be
+        considered finished.
+    maxrate : float, default = None
+        Maximum transfer rate in MB/s. None for no limit.
+    chunksize : float, default = 1
+        Size of the transferred chunks in MB.
+    keep : bool, default = False
+        If the local files should be kept after they have been transferred.
+        Kept files are listed with their size and modification time in the
+        .offloaded file in the source directory, such that they are only
+        offloaded again when they have changed.
+    continuous : bool, default = False
+        If new recordings should be offloaded continuously, checking every
+        interval seconds, or only the current recordings once.
+    interval : float, default = 10
+        Time in seconds between checks for new recordings.
+    lockfile : str, default = None
+        The recording lock file, by default the recording.lock file in the
+        pirecorder folder.
+    """
+
+    def __init__(self, source = "pirecorder/recordings", target = "NAS",
+                 wait = 60, maxrate = None, chunksize = 1, keep = False,
+                 continuous = False, interval = 10, lockfile = None):
+
+        self.source = source if os.path.isabs(source) else homedir() + source
+        self.target = _target(target)
+        self.wait = wait
+        self.maxrate = maxrate
+        self.chunksize = int(chunksize * 1e6)
+        self.keep = keep
+        self.lockfile = lockfile
+        self.manifest = os.path.join(self.source, ".offloaded")
+        self.offloaded = self._readmanifest() if keep else {}
+
+        try:
+            while True:
+                self.run()
+                if not continuous:
+                    break
+                sleep(interval)
+        except KeyboardInterrupt:
+            lineprint("User terminated offloading..")
+        finally:
+            self.target.close()
+
+
+    def _readmanifest(self):
+
+        """Returns the size and mtime of the files that were offloaded"""
+
+        if not os.path.isfile(self.manifest):
+            return {}
+        try:
+            with open(self.manifest) as f:
+                return json.load(f)
+        except ValueError:
+            lineprint("Offload manifest unreadable, offloading all files..")
+            return {}
+
+
+    def _writemanifest(self):
+
+        """Stores the offloaded files, replacing the manifest atomically"""
+
+        with open(self.manifest + ".tmp", "w") as f:
+            json.dump(self.offloaded, f)
+        os.replace(self.manifest + ".tmp", self.manifest)
+
+
+    def _stat(self, filename):
+
+        stat = os.stat(filename)
+
+        return [stat.st_size, stat.st_mtime]
+
+
+    def _files(self):
+
+        """Returns the finished files in the source folder, oldest first"""
+
+        files = []
+        for root, dirs, names in os.walk(self.source):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if name.startswith(".") or name.endswith((".partial",".tmp")):
+                    continue
+                filename = os.path.join(root, name)
+                rel = os.path.relpath(filename, self.source)
+                if self.offloaded.get(rel) == self._stat(filename):
+                    continue
+                mtime = os.path.getmtime(filename)
+                if time() - mtime >= self.wait:
+                    files.append((mtime, filename))
+
+        return [filename for _, filename in sorted(files)]
+
+
+    def _pause(self):
+
+        """Waits while a recording is active"""
+
+        if not recording(self.lockfile):
+            return
+        lineprint("Recording active, pausing offload..")
+        while recording(self.lockfile):
+            sleep(1)
+        lineprint("Recording finished, resuming offload..")
+
+
+    def transfer(self, filename):
+
+        """Transfers a single file, resuming a previous partial transfer"""
+
+        rel = os.path.relpath(filename, self.source)
+        stat = self._stat(filename)
+        size = stat[0]
+        offset = self.target.offset(rel)
+        offset = 0 if offset > size else offset
+        sha = hashlib.sha256()
+
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(min(self.chunksize,
+                                                 offset - f.tell())), b""):
+                sha.update(chunk)
+            if offset > 0:
+                lineprint("Resuming "+rel+" at "+str(round(offset/1e6,1))+"MB..")
+            while True:
+                self._pause()
+                start = monotonic()
+                data = f.read(self.chunksize)
+                if len(data) == 0:
+                    break
+                sha.update(data)
+                self.target.write(rel, f.tell() - len(data), data)
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, f.tell(),
+                                     os.POSIX_FADV_DONTNEED)
+                if self.maxrate:
+                    sleep(max(0, len(data)/(self.maxrate*1e6)-(monotonic()-start)))
+            if size == 0:
+                self.target.write(rel, 0, b"")
+
+        if not self.target.finish(rel, sha.hexdigest()):
+            lineprint("Checksum of "+rel+" did not match, will retry..")
+            return False
+        if self.keep:
+            self.offloaded[rel] = stat
+            self._writemanifest()
+        else:
+            os.remove(filename)
+        lineprint("Offloaded "+rel)
+
+        return True
+
+
+    def run(self):
+
+        """Transfers all currently finished files"""
+
+        for filename in self._files():
+            try:
+                self.transfer(filename)
+            except (IOError, OSError) as e:
+                lineprint("Offloading "+filename+" failed: "+str(e))
+
+
+class OffloadServer:
+
+    """
+    Receives offloaded recordings over TCP and stores them in a directory, for
+    targets that are not mounted as a network drive. The server does not
+    authenticate its peers, so it should only listen on a trusted network.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to store the recordings in.
+    port : int, default = 8765
+        The port to listen on.
+    host : str, default = "127.0.0.1"
+        The address to listen on, by default only the local host. Use "" to
+        listen on all interfaces, such that other devices can offload to it.
+    """
+
+    def __init__(self, directory, port = 8765, host = "127.0.0.1"):
+
+        self.target = _DirTarget(directory)
+        self.port = port
+        self.host = host
+
+        self.serve()
+
+
+    def handle(self, message, f):
+
+        """Handles a single request and returns the response"""
+
+        command, rel = message.get("command"), message.get("path", "")
+        if command == "offset":
+            return {"status": "ok", "offset": self.target.offset(rel)}
+        if command == "write":
+            data = f.read(message["size"])
+            self.target.write(rel, message["offset"], data)
+            return {"status": "ok"}
+        if command == "finish":
+            verified = self.target.finish(rel, message["checksum"])
+            return {"status": "ok", "verified": verified}
+
+        return {"status": "error", "error": "unknown command "+str(command)}
+
+
+    def serve(self):
+
+        """Handles connections until a keyboard interrupt"""
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen(5)
+        lineprint("Offload server listening on "+(self.host or "all interfaces")+\
+                  ":"+str(self.port)+"..")
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                with conn, conn.makefile("rb") as f:
+                    for line in iter(f.readline, b""):
+                        try:
+                            response = self.handle(json.loads(line), f)
+                        except Exception as e:
+                            response = {"status": "error", "error": str(e)}
+                        conn.sendall((json.dumps(response)+"\n").encode())
+        except KeyboardInterrupt:
+            lineprint("User terminated offload server..")
+        finally:
+            server.close()
+
+
+def offl():
+
+    """To run the offload pipeline or server from the command line"""
+
+    parser = argparse.ArgumentParser(prog="offload",
+             description=Offload.__doc__,
+             formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-s", "--source", default="pirecorder/recordings",
+                        metavar="")
+    parser.add_argument("-t", "--target", default="NAS", metavar="")
+    parser.add_argument("-w", "--wait", default=60, type=float, metavar="")
+    parser.add_argument("-r", "--maxrate", default=None, type=float,
+                        metavar="")
+    parser.add_argument("-k", "--keep", action="store_true")
+    parser.add_argument("-c", "--continuous", action="store_true")
+    parser.add_argument("--serve", default=None, type=int, metavar="PORT",
+                        help="store files received on PORT in target")
+    parser.add_argument("--host", default="127.0.0.1", metavar="",
+                        help="address the server listens on, '' for all")
+
+    args = parser.parse_args()
+    if args.serve is not None:
+        OffloadServer(args.target, port = args.serve, host = args.host)
+    else:
+        os.nice(10)
+        Offload(source = args.source, target = args.target, wait = args.wait,
+                maxrate = args.maxrate, keep = args.keep,
+                continuous = args.continuous)
@@ -0,0 +1,298 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+from time import monotonic
+from threading import Lock
+
+class DeferredOutput:
+
+    """
+    Custom picamera output that holds encoded data in memory until release()
+    is called, after which all data is passed on to the underlying file. This
+    makes it possible to switch the encoder to a file without losing frames,
+    while other data (e.g. a pre-trigger buffer) is still written to it first.
+    When writing to a TimestampOutput, the frame of the data held in memory is
+    stored with it, such that the frames are registered correctly on release.
+    """
+
+    def __init__(self, fileobj):
+
+        self.fileobj = fileobj
+        self.frames = isinstance(fileobj, TimestampOutput)
+        self.pending = []
+        self.released = False
+        self.lock = Lock()
+
+
+    def write(self, buf):
+
+        with self.lock:
+            if self.released:
+                self.fileobj.write(buf)
+            else:
+                frame = self.fileobj.frame() if self.frames else None
+                self.pending.append((bytes(buf), frame))
+
+        return len(buf)
+
+
+    def release(self):
+
+        """Writes the data held in memory and passes on all further data"""
+
+        with self.lock:
+            for buf, frame in self.pending:
+                if self.frames:
+                    self.fileobj.writeframe(buf, frame)
+                else:
+                    self.fileobj.write(buf)
+            self.pending = []
+            self.released = True
+
+
+    def flush(self):
+
+        self.fileobj.flush()
+
+
+class TimestampOutput:
+
+    """
+    Custom picamera output that writes the encoded video to a file and stores
+    the index, sensor timestamp (in microseconds) and keyframe flag of each
+    frame in a csv sidecar file. Rows are buffered in memory and written in
+    batches, such that the encoder is not slowed down. The time taken by each
+    write to the video file is kept in the latencies attribute.
+
+    Parameters
+    ----------
+    camera : PiCamera
+        The camera instance that is recording.
+    filename : str
+        The video file to write to. The sidecar file gets the same name with
+        "_frames.csv" replacing the extension.
+    batch : int, default = 250
+        Number of frames after which the buffered rows are written.
+    port : int, default = 1
+        The splitter port of the recording, such that the frames of other
+        encoders, e.g. a motion detector, are not registered.
+    """
+
+    def __init__(self, camera, filename, batch = 250, port = 1):
+
+        from picamera import PiVideoFrameType
+
+        self.camera = camera
+        self.port = port
+        self.filename = filename
+        self.keyframe = PiVideoFrameType.key_frame
+        self.batch = batch
+        self.rows = []
+        self.frames = 0
+        self.first = None
+        self.last = None
+        self.started = None
+        self.latencies = []
+
+        self.fileobj = open(filename, "wb")
+        self.sidecar = open(os.path.splitext(filename)[0]+"_frames.csv", "w")
+        self.sidecar.write("frame,timestamp,keyframe\n")
+
+
+    def frame(self):
+
+        """Returns the current frame of the recording"""
+
+        encoder = self.camera._encoders.get(self.port)
+
+        return encoder.frame if encoder is not None else None
+
+
+    def write(self, buf):
+
+        return self.writeframe(buf, self.frame())
+
+
+    def writeframe(self, buf, frame):
+
+        """Writes the data of a frame to the file and registers the frame"""
+
+        start = monotonic()
+        self.fileobj.write(buf)
+        self.latencies.append(monotonic() - start)
+        self._register(frame, start)
+
+        return len(buf)
+
+
+    def _register(self, frame, start):
+
+        if frame is None or not frame.complete or frame.timestamp is None:
+            return
+        keyframe = int(frame.frame_type == self.keyframe)
+        self.rows.append("%d,%d,%d\n" % (frame.index, frame.timestamp, keyframe))
+        self.frames += 1
+        if self.first is None:
+            self.first, self.started = frame.timestamp, start
+        self.last = frame.timestamp
+        if len(self.rows) >= self.batch:
+            self.sidecar.write("".join(self.rows))
+            self.rows = []
+
+
+    def copy(self, buffer, seconds):
+
+        """
+        Copies the last seconds of a PiCameraCircularIO buffer, starting at a
+        header frame like PiCameraCircularIO.copy_to, and registers its frames
+        """
+
+        from picamera import PiVideoFrameType
+
+        frames = list(buffer.frames)
+        start, last = None, None
+        for frame in reversed(frames):
+            if frame.frame_type == PiVideoFrameType.sps_header:
+                start = frame.position
+            if frame.timestamp is not None:
+                if last is None:
+                    last = frame.timestamp
+                elif last - frame.timestamp >= seconds * 1000000:
+                    break
+        if start is None:
+            return
+        began = monotonic()
+        buffer.copy_to(self.fileobj, seconds = seconds)
+        for frame in frames:
+            if frame.position >= start:
+                self._register(frame, began)
+
+
+    def flush(self):
+
+        self.sidecar.write("".join(self.rows))
+        self.rows = []
+        self.sidecar.flush()
+        self.fileobj.flush()
+
+
+    def fps(self):
+
+        """Returns the framerate achieved based on the sensor timestamps"""
+
+        if self.frames < 2 or self.last == self.first:
+            return 0.
+
+        return (self.frames - 1) / ((self.last - self.first) / 1000000.)
+
+
+    def close(self):
+
+        """Writes all remaining rows and closes the video and sidecar files"""
+
+        self.flush()
+        self.fileobj.close()
+        self.sidecar.close()
+
+
+class ArrayOutput:
+
+    """
+    Custom picamera output that stores unencoded yuv captures in a single
+    preallocated memory-mapped npy file, which can be opened with
+    numpy.load(filename, mmap_mode="r") without copying. Frames are stored
+    at the position set by the index attribute, such that the array index can
+    correspond to the slot in a timed sequence.
+
+    Parameters
+    ----------
+    filename : str
+        The npy file to create.
+    nr : int
+        Number of frames to allocate.
+    resolution : tuple
+        Width and height of the captured frames.
+    gray : bool, default = True
+        If only the grayscale (Y) plane should be stored, resulting in an
+        array of shape (nr, height, width). Otherwise the full frame is stored
+        in I420 layout with shape (nr, height*3/2, width), which can be
+        converted with cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420).
+    """
+
+    def __init__(self, filename, nr, resolution, gray = True):
+
+        from numpy.lib.format import open_memmap
+
+        self.w, self.h = resolution
+        if not gray:
+            self.w, self.h = self.w // 2 * 2, self.h // 2 * 2
+        self.fw = (resolution[0] + 31) // 32 * 32
+        self.fh = (resolution[1] + 15) // 16 * 16
+        self.framesize = self.fw * self.fh * 3 // 2
+        self.gray = gray
+        shape = (nr, self.h, self.w) if gray else (nr, self.h*3//2, self.w)
+        self.array = open_memmap(filename, mode = "w+", dtype = "uint8",
+                                 shape = shape)
+        self.buffer = bytearray()
+        self.index = 0
+        self.frames = 0
+
+
+    def write(self, buf):
+
+        self.buffer += buf
+        if len(self.buffer) >= self.framesize:
+            self._store()
+
+        return len(buf)
+
+
+    def _store(self):
+
+        import numpy as np
+
+        data = np.frombuffer(self.buffer, dtype = np.uint8,
+                             count = self.framesize)
+        ysize, csize = self.fw * self.fh, self.fw * self.fh // 4
+        y = data[:ysize].reshape((self.fh, self.fw))[:self.h, :self.w]
+        if self.gray:
+            self.array[self.index] = y
+        else:
+            frame = self.array[self.index].reshape(-1)
+            chroma = (self.fh // 2, self.fw // 2)
+            u = data[ysize:ysize+csize].reshape(chroma)
+            v = data[ysize+csize:ysize+2*csize].reshape(chroma)
+            frame[:self.h*self.w] = y.reshape(-1)
+            size = self.h * self.w // 4
+            frame[self.h*self.w:][:size] = u[:self.h//2, :self.w//2].reshape(-1)
+            frame[self.h*self.w+size:] = v[:self.h//2, :self.w//2].reshape(-1)
+        self.buffer = self.buffer[self.framesize:]
+        self.frames += 1
+
+
+    def flush(self):
+
+        pass
+
+
+    def close(self):
+
+        """Writes all frames to disk and closes the memory-mapped file"""
+
+        self.array.flush()
+        del self.array
@@ -19,28 +19,28 @@ from __future__ import print_function
 from builtins import input
 
 import os
-import cv2
 import sys
-import yaml
 
 import argparse
-import numpy as np
 from io import BytesIO
-from ast import literal_eval
 from datetime import datetime
 from socket import gethostname
 from fractions import Fraction
-from time import sleep, strftime
-from localconfig import LocalConfig
+from time import sleep, strftime, monotonic
 from pythutils.sysutils import Logger, lineprint, homedir, checkfrac, isrpi
 from pythutils.fileutils import name
-from pythutils.mediautils import picamconv
 
-from .stream import Stream
-from .camconfig import Camconfig
-from .schedule import Schedule
+from .config import loadconfig, saveconfig, copyconfig, loadyml, snapshot
+from .timer import DeadlineTimer, intervalstats
+from .writer import WriteBehind
+from .trigger import Trigger
+from .outputs import DeferredOutput, TimestampOutput, ArrayOutput
+from .lock import RecordingLock
+from .metrics import Metrics
 from .__version__ import __version__
 
+_vidtypes = ["vid","vidseq","vidbuf","vidseg"]
+
 class PiRecorder:
 
     """
@@ -93,20 +93,26 @@ class PiRecorder:
         self.configfilerel = configfile
         self.configfile = self.setupdir+"/"+configfile
 
-        self.config = LocalConfig(self.configfile, compact_form = True)
+        self.config = loadconfig(self.configfile)
         if not os.path.isfile(self.configfile):
             lineprint("Config file "+configfile+" not found, new file created..")
             for section in ["rec","cam","cus","img","vid"]:
                 if section not in list(self.config):
                     self.config.add_section(section)
             self.settings(recdir="pirecorder/recordings",subdirs=False,
-                          label="test",rectype="img",rotation=0,brighttune=0,
+                          label="test",rectype="img",motion=0,motionwait=5,
+                          storagecheck=False,adaptive=False,promfile="",
+                          rotation=0,brighttune=0,
                           roi=None,gains=(1.0,2.5),brightness=45,contrast=10,
                           saturation=0,iso=200,sharpness=0,compensation=0,
                           shutterspeed=8000,imgdims=(2592,1944),maxres=None,
                           viddims=(1640,1232),imgfps=1,vidfps=24,imgwait=5.0,
-                          imgnr=12,imgtime=60,imgquality=50,vidduration=10,
-                          viddelay=10,vidquality=11,automode=True,internal="")
+                          imgnr=12,imgtime=60,imgquality=50,imgbuffer=0,
+                          rawformat="gray",
+                          vidduration=10,viddelay=10,vidquality=11,
+                          segduration=600,segsize=0,timestamps=True,
+                          bufsecs=5,buftime=3600,
+                          automode=True,internal="")
             lineprint("Config settings stored..")
 
         else:
@@ -116,7 +122,7 @@ class PiRecorder:
 
         self._imgparams()
         self._shuttertofps()
-        if self.config.rec.rectype == "imgseq":
+        if self.config.rec.rectype in ["imgseq","rawseq"]:
             if self.config.cam.shutterspeed/1000000.>=(self.config.img.imgwait/5):
                 lineprint("imgwait is not enough for provided shutterspeed" + \
                           ", will be overwritten..")
@@ -132,34 +138,52 @@ class PiRecorder:
         os.chdir(self.recdir)
 
 
+    def _camsettings(self):
+
+        """Returns the configuration values that determine the camera set up"""
+
+        rectype = self.config.rec.rectype
+        camtype = "img" if rectype in ["img","imgseq","rawseq"] else "vid"
+        settings = [camtype] + list(self.config.cam) + list(self.config.cus)
+        if camtype == "img":
+            settings += [self.config.img.imgdims, self.config.img.imgfps]
+        else:
+            settings += [self.config.vid.viddims, self.config.vid.vidfps]
+
+        return str(settings)
+
+
     def _setup_cam(self, auto = False, fps = None):
 
         """Sets up the raspberry pi camera based on the configuration"""
 
         import picamera
         import picamera.array
+        from pythutils.mediautils import picamconv
 
+        start = monotonic()
+        params = snapshot(self.config)
         self.cam = picamera.PiCamera()
         self.cam.rotation = self.config.cus.rotation
         self.cam.exposure_compensation = self.config.cam.compensation
 
-        if self.config.rec.rectype in ["img","imgseq"]:
-            self.cam.resolution = literal_eval(self.config.img.imgdims)
+        if self.config.rec.rectype in ["img","imgseq","rawseq"]:
+            self.cam.resolution = params.imgdims
             self.cam.framerate = self.config.img.imgfps
-        if self.config.rec.rectype in ["vid","vidseq"]:
-            self.cam.resolution = picamconv(literal_eval(self.config.vid.viddims))
+        if self.config.rec.rectype in _vidtypes + ["imgburst"]:
+            self.cam.resolution = picamconv(params.viddims)
             self.cam.framerate = self.config.vid.vidfps
         if fps != None:
             self.cam.framerate = fps
 
-        if self.config.cus.roi is None:
+        if params.roi is None:
             self.cam.zoom = (0,0,1,1)
             self.resize = self.cam.resolution
         else:
-            self.cam.zoom = literal_eval(self.config.cus.roi)
+            self.cam.zoom = params.roi
             w = int(self.cam.resolution[0]*self.cam.zoom[2])
             h = int(self.cam.resolution[1]*self.cam.zoom[3])
-            if self.config.rec.rectype in ["vid","vidseq"]:
+            if self.config.rec.rectype in _vidtypes + ["imgburst"]:
                 self.resize = picamconv((w,h))
             else:
                 self.resize = (w,h)
@@ -168,6 +192,8 @@ class PiRecorder:
 
         self.cam.exposure_mode = "auto"
         self.cam.awb_mode = "auto"
+        self.camtimes = {"setup": monotonic() - start}
+        self.camsettings = None if auto or fps != None else self._camsettings()
         lineprint("Camera warming up..")
         if auto or self.config.cam.automode:
             self.cam.shutter_speed = 0
@@ -180,8 +206,9 @@ class PiRecorder:
             self.cam.shutter_speed = self.config.cam.shutterspeed
             self.cam.exposure_mode = "off"
             self.cam.awb_mode = "off"
-            self.cam.awb_gains = eval(self.config.cus.gains)
+            self.cam.awb_gains = params.gains
             sleep(0.1)
+        self.camtimes["warmup"] = monotonic() - start - self.camtimes["setup"]
 
         brightness = self.config.cam.brightness + self.config.cus.brighttune
         self.cam.brightness = brightness
@@ -192,6 +219,7 @@ class PiRecorder:
 
         self.rawCapture = picamera.array.PiRGBArray(self.cam,
                           size=self.cam.resolution)
+        self.flickerfixed = False
 
 
     def _imgparams(self, mintime = 0.45):
@@ -199,12 +227,14 @@ class PiRecorder:
         """
         Calculates minimum possible imgwait and imgnr based on imgtime. The
         minimum time between subsequent images is by default set to 0.45s, the
-        time it takes to take an image with max resolution.
+        time it takes to take an image with max resolution. The number of
+        images is only limited for image sequences, as bursts are not timed.
         """
 
         self.config.img.imgwait = max(mintime, self.config.img.imgwait)
-        totimg = int(self.config.img.imgtime / self.config.img.imgwait)
-        self.config.img.imgnr = min(self.config.img.imgnr, totimg)
+        if self.config.rec.rectype in ["imgseq","rawseq"]:
+            totimg = int(self.config.img.imgtime / self.config.img.imgwait)
+            self.config.img.imgnr = min(self.config.img.imgnr, totimg)
 
 
     def _shuttertofps(self, minfps = 1, maxfps = 40):
@@ -223,8 +253,10 @@ class PiRecorder:
         contain a sequence number. e.g. test_180708_pi12_S01_100410
         """
 
-        imgtypes = ["img","imgseq"]
+        imgtypes = ["img","imgseq","imgburst"]
         self.filetype = ".jpg" if self.config.rec.rectype in imgtypes else ".h264"
+        if self.config.rec.rectype == "rawseq":
+            self.filetype = ".npy"
 
         if self.config.rec.rectype == "imgseq":
             date = strftime("%y%m%d")
@@ -259,7 +291,7 @@ class PiRecorder:
 
             self.config.cam.shutterspeed = self.cam.exposure_speed
             self.config.cus.gains = tuple([round(float(i),2) for i in self.cam.awb_gains])
-            self.config.save()
+            saveconfig(self.config, self.configfile)
             lineprint("Shutterspeed set to "+str(self.cam.exposure_speed))
             lineprint("White balance gains set to "+str(self.config.cus.gains))
 
@@ -271,7 +303,9 @@ class PiRecorder:
     def settings(self, **kwargs):
 
         """
-        Configure the camera and recording settings
+        Configure the camera and recording settings. Settings are validated
+        before being stored, with invalid values raising a ValueError, and the
+        configuration file is only rewritten when a value actually changed.
 
         Parameters
         ---------------
@@ -280,16 +314,68 @@ class PiRecorder:
             If different, a folder with name corresponding to location will be
             created inside the home directory. If no name is provided (""), the
             files are stored in the home directory. If "NAS" is provided it will
-            additionally check if the folder links to a mounted drive.
+            additionally check if the folder links to a mounted drive. As writing
+            directly to a network drive can cause stalls that the h264 encoder
+            cannot absorb, it is recommended to record to local storage and to
+            move recordings in the background with the offload command.
         subdirs : bool, default = False
             If files of individual recordings should be stored in subdirectories
             or not, to keep all files of a single recording session together.
         label : str, default = "test"
             Label that will be associated with the specific recording and stored
             in the filenames.
-        rectype : ["img", "imgseq", "vid", "vidseq"], default = "img"
+        rectype : ["img", "imgseq", "imgburst", "rawseq", "vid", "vidseq",
+            "vidseg", "vidbuf"], default = "img"
             Recording type, either a single image or video or a sequence of
-            images or videos.
+            images or videos. With "imgburst" imgnr images are captured as
+            fast as possible through the video port, with the resolution set
+            by viddims and the framerate by vidfps, which allows for bursts of
+            10-30 images per second. With "rawseq" an image sequence is
+            captured like with "imgseq" but stored unencoded in a single
+            memory-mapped numpy (.npy) file, with frame i at index i, which
+            can be opened without copying with np.load(file, mmap_mode="r").
+            With "vidseg" a single continuous video of
+            vidduration + viddelay seconds is recorded, split without any gaps
+            into separate files every segduration seconds or segsize MB. With
+            "vidbuf" the camera continuously records
+            into a ring buffer in memory, and on each trigger stores a video
+            containing the buffered bufsecs seconds before the trigger plus
+            vidduration seconds after it, for up to buftime seconds. Triggers
+            are given by creating a file named "trigger" in the pirecorder
+            folder, by sending the SIGUSR1 signal to the recording process, or
+            by calling the trigger() method.
+        motion : float, default = 0
+            Records only while there is activity in the roi. Activity is
+            detected by frame differencing of a low resolution stream and is
+            expressed as the fraction of pixels that changed between subsequent
+            frames, which should exceed the provided value (e.g. 0.005). With
+            rectype "vid", vidduration and viddelay then set the total time
+            that is monitored, and a new video is stored for each period of
+            activity. With rectype "imgseq", images are only taken at the
+            imgwait intervals during which there is activity. The default (0)
+            records irrespective of activity.
+        motionwait : float, default = 5
+            The time in seconds that recording continues after activity was
+            last detected.
+        storagecheck : bool, default = False
+            If it should be checked before each recording whether the storage
+            of recdir can sustain the data rate that is predicted from the
+            recording type, dimensions, quality, and framerate or imgwait. The
+            sustained write throughput and write latency of the storage are
+            measured once and stored per mount point in the storage.yml file
+            in the pirecorder folder.
+        adaptive : bool, default = False
+            If the quality, and if needed the resolution, should be lowered
+            automatically for a recording when the storage cannot sustain the
+            predicted data rate. The stored configuration is not changed.
+        promfile : str, default = ""
+            Performance metrics of each recording (camera set up and warm up
+            time, time to first frame, achieved fps, frames captured versus
+            expected, bytes written, write latency, and cpu temperature and
+            throttle state) are appended as a json line to metrics.jsonl in
+            the logs folder. If a filename is provided, the metrics of the
+            last recording are also stored there as a Prometheus textfile,
+            e.g. for the textfile collector of the node exporter.
         automode : bool, default = True
             If the shutterspeed and white balance should be set automatically
             and dynamically for each recording.
@@ -366,7 +452,11 @@ class PiRecorder:
             parameter and so images are taken immideately one after the other.
             To take a sequence of images at the exact right delay interval the
             imgwait parameter should be at least 5x the shutterspeed (e.g.
-            shutterspeed of 400ms needs imgwait of 2s).
+            shutterspeed of 400ms needs imgwait of 2s). Images are timed on
+            fixed deadlines from the start of the sequence, so slots that are
+            missed due to an overrun are skipped instead of delaying all
+            subsequent images. A timing report with the jitter and overrun per
+            image is stored alongside the images.
         imgnr : int, default = 12
             The number of images that should be taken. When this number is
             reached, the recorder will automatically terminate.
@@ -378,6 +468,19 @@ class PiRecorder:
             Specifies the quality that the jpeg encoder should attempt to
             maintain. Use values between 1 and 100, where higher values are
             higher quality.
+        imgbuffer : int, default = 0
+            The number of images of an image sequence that can be held in
+            memory while waiting to be written to disk by background writers.
+            This decouples capturing from slow writes to the storage medium,
+            allowing shorter imgwait times on slow SD cards. When the buffer is
+            full, capturing waits for the writers to catch up. The default (0)
+            writes each image directly to disk.
+        rawformat : ["gray", "yuv"], default = "gray"
+            The frame format when recording with rectype "rawseq". With "gray"
+            only the luminance is stored, as an array of shape (imgnr, height,
+            width). With "yuv" the full frames are stored in I420 layout, with
+            shape (imgnr, height*3/2, width), which can be converted to color
+            with cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420).
         vidduration : int, default = 10
             Duration of video recording in seconds.
         viddelay : int, default = 0
@@ -389,8 +492,33 @@ class PiRecorder:
             Specifies the quality that the h264 encoder should attempt to
             maintain. Use values between 10 and 40, where 10 is extremely high
             quality, and 40 is extremely low.
+        segduration : int, default = 600
+            The maximum duration in seconds of each file when recording with
+            rectype "vidseg". Files are split at the next keyframe, which is
+            recorded every second, such that no frames are lost.
+        segsize : int, default = 0
+            The maximum size in MB of each file when recording with rectype
+            "vidseg". The default (0) only splits files based on segduration.
+        timestamps : bool, default = True
+            If each video should be accompanied by a csv file with the frame
+            index, sensor timestamp (in microseconds), and keyframe flag of
+            each frame, named after the video with "_frames.csv" appended. This
+            makes it possible to detect dropped or irregular frames and to
+            determine the framerate that was actually achieved.
+        bufsecs : int, default = 5
+            The number of seconds before a trigger that are held in memory and
+            stored with each video when recording with rectype "vidbuf". Only
+            encoded video is buffered, such that even long buffers fit in the
+            memory of a raspberry pi zero.
+        buftime : int, default = 3600
+            The total time in seconds that triggers are waited for when
+            recording with rectype "vidbuf", after which the recording ends.
+            A video that is being stored when the time is up is completed.
+            With 0 triggers are waited for until the recording is stopped.
         """
 
+        previous = copyconfig(self.config)
+
         if "recdir" in kwargs:
             self.config.rec.recdir = kwargs["recdir"]
         if "subdirs" in kwargs:
@@ -399,6 +527,16 @@ class PiRecorder:
             self.config.rec.label = kwargs["label"]
         if "rectype" in kwargs:
             self.config.rec.rectype = kwargs["rectype"]
+        if "motion" in kwargs:
+            self.config.rec.motion = kwargs["motion"]
+        if "motionwait" in kwargs:
+            self.config.rec.motionwait = kwargs["motionwait"]
+        if "storagecheck" in kwargs:
+            self.config.rec.storagecheck = kwargs["storagecheck"]
+        if "adaptive" in kwargs:
+            self.config.rec.adaptive = kwargs["adaptive"]
+        if "promfile" in kwargs:
+            self.config.rec.promfile = kwargs["promfile"]
         if "maxres" in kwargs:
             self.config.rec.maxres = kwargs["maxres"]
             if isinstance(self.config.rec.maxres, tuple):
@@ -450,6 +588,10 @@ class PiRecorder:
             self.config.img.imgtime = kwargs["imgtime"]
         if "imgquality" in kwargs:
             self.config.img.imgquality = kwargs["imgquality"]
+        if "imgbuffer" in kwargs:
+            self.config.img.imgbuffer = kwargs["imgbuffer"]
+        if "rawformat" in kwargs:
+            self.config.img.rawformat = kwargs["rawformat"]
 
         if "vidduration" in kwargs:
             self.config.vid.vidduration = kwargs["vidduration"]
@@ -457,33 +599,118 @@ class PiRecorder:
             self.config.vid.viddelay = kwargs["viddelay"]
         if "vidquality" in kwargs:
             self.config.vid.vidquality = kwargs["vidquality"]
+        if "segduration" in kwargs:
+            self.config.vid.segduration = kwargs["segduration"]
+        if "segsize" in kwargs:
+            self.config.vid.segsize = kwargs["segsize"]
+        if "timestamps" in kwargs:
+            self.config.vid.timestamps = kwargs["timestamps"]
+        if "bufsecs" in kwargs:
+            self.config.vid.bufsecs = kwargs["bufsecs"]
+        if "buftime" in kwargs:
+            self.config.vid.buftime = kwargs["buftime"]
 
         brightchange = False
         if os.path.exists(self.brightfile):
-            with open(self.brightfile) as f:
-                brighttune = yaml.load(f, Loader=yaml.FullLoader)
-                if brighttune != self.config.cus.brighttune:
-                    self.config.cus.brighttune = brighttune
-                    brightchange = True
+            brighttune = loadyml(self.brightfile)
+            if brighttune != self.config.cus.brighttune:
+                self.config.cus.brighttune = brighttune
+                brightchange = True
 
         if len(kwargs) > 0 or brightchange:
 
-            self._imgparams()
-            self._shuttertofps()
-            if self.config.rec.rectype == "imgseq":
+            try:
+                self._imgparams()
+                self._shuttertofps()
+                snapshot(self.config)
+            except Exception:
+                self.config = previous
+                raise
+            if self.config.rec.rectype in ["imgseq","rawseq"]:
                 if self.config.cam.shutterspeed/1000000. >= (self.config.img.imgwait/5):
                     lineprint("imgwait is not enough for provided shutterspeed" + \
                               ", will be overwritten..")
-            self.config.save()
+            saveconfig(self.config, self.configfile)
 
             if "internal" not in kwargs:
                 lineprint("Config settings stored and loaded..")
 
 
+    def storage(self, refresh = False):
+
+        """
+        Returns the sustained write throughput (MB/s) and write latency
+        percentiles (s) of the storage of recdir. The storage is only measured
+        when it was not measured before or when refresh is True.
+        """
+
+        from .storage import storagespeed
+
+        return storagespeed(self.recdir, self.setupdir+"/storage.yml", refresh)
+
+
+    def _checkstorage(self, headroom = 0.8):
+
+        """
+        Compares the predicted data rate of the recording with the throughput
+        of the storage, and lowers quality and resolution if needed and
+        adaptive is set. Only the configuration in memory is changed, which
+        record restores afterwards. Returns if the resolution was changed.
+        """
+
+        from .storage import datarate
+
+        rectype = self.config.rec.rectype
+        if rectype == "img":
+            return False
+        params = snapshot(self.config)
+        imgdims = rectype in ["imgseq", "rawseq"]
+        dimskey = "imgdims" if imgdims else "viddims"
+        dims = params.imgdims if imgdims else params.viddims
+        qualkey = "imgquality" if rectype in ["imgseq", "imgburst"] else \
+                  "vidquality" if rectype in _vidtypes else None
+        section = self.config.img if dimskey == "imgdims" else self.config.vid
+        qsection = self.config.img if qualkey == "imgquality" else self.config.vid
+        roi = params.roi if params.roi is not None else (0, 0, 1, 1)
+
+        def rate():
+            quality = getattr(qsection, qualkey) if qualkey else None
+            size = (dims[0] * roi[2], dims[1] * roi[3])
+            return datarate(rectype, size, quality, self.config.vid.vidfps,
+                            self.config.img.imgwait, self.config.img.rawformat)
+
+        limit = self.storage()["throughput"] * headroom
+        if rate() <= limit:
+            return False
+        lineprint("Predicted data rate of "+str(round(rate(), 1))+" MB/s "+\
+                  "exceeds what the storage sustains ("+str(round(limit, 1))+\
+                  " MB/s)..")
+        if not self.config.rec.adaptive:
+            return False
+
+        while rate() > limit and qualkey == "vidquality" and \
+              qsection.vidquality < 40:
+            qsection.vidquality = min(40, max(qsection.vidquality, 17) + 3)
+        while rate() > limit and qualkey == "imgquality" and \
+              qsection.imgquality > 10:
+            qsection.imgquality = max(10, qsection.imgquality - 10)
+        olddims = dims
+        while rate() > limit and dims[0] > 320:
+            dims = (int(dims[0] * 0.8) // 32 * 32, int(dims[1] * 0.8) // 16 * 16)
+        setattr(section, dimskey, dims)
+        lineprint("Adapted recording to "+str(round(rate(), 1))+" MB/s with "+\
+                  dimskey+" "+str(dims)+(", "+qualkey+" "+\
+                  str(getattr(qsection, qualkey)) if qualkey else "")+"..")
+
+        return dims != olddims
+
+
     def stream(self, fps = None):
 
         """Shows an interactive video stream"""
 
+        from .stream import Stream
+
         lineprint("Opening stream for cam positioning and roi extraction..")
         vidstream = Stream(internal=True, rotation=self.config.cus.rotation,
                        maxres=self.config.rec.maxres)
@@ -495,6 +722,8 @@ class PiRecorder:
 
     def camconfig(self, fps=None, vidsize=0.4):
 
+        from .camconfig import Camconfig
+
         lineprint("Opening stream for interactive configuration..")
         fps = max(self.config.vid.vidfps,1) if fps==None else int(fps)
         self._setup_cam(fps=fps)
@@ -505,7 +734,7 @@ class PiRecorder:
 
 
     def schedule(self, jobname = None, timeplan = None, enable = True,
-                 showjobs = False, delete = None, test = False):
+                 showjobs = False, delete = None, test = False, daemon = False):
 
         """
         Schedule future recordings
@@ -547,6 +776,11 @@ class PiRecorder:
             The name of the configuration file to be used for the scheduled
             recordings. Make sure the file exists, otherwise the default
             configuration settings will be used.
+        daemon : bool, default = False
+            If the scheduled job should send the recording request to a running
+            recorder daemon (see the Daemon class), which keeps the camera open
+            and ready such that the recording starts without delay. If the
+            daemon is not running, the job records directly instead.
 
         Note: Make sure Recorder configuration timing settings are within the
         timespan between subsequent scheduled recordings based on the provided
@@ -555,76 +789,451 @@ class PiRecorder:
         This will be checked automatically.
         """
 
+        from .schedule import Schedule
+
         S = Schedule(jobname, timeplan, enable, showjobs, delete, test,
                      logfolder = self.logfolder, internal=True,
-                     configfile = self.configfilerel)
+                     configfile = self.configfilerel, daemon = daemon)
 
 
-    def record(self):
+    def trigger(self):
 
-        """
-        Starts a recording as configured and returns either one or multiple
-        .h264 or .jpg files that are named automatically according to the label,
-        the host name, date, time and potentially session number or count nr.
+        """Triggers storing a video when recording with rectype "vidbuf" """
 
-        Example output files:
-        rectype = "img" : test_180312_pi13_101300.jpg
-        rectype = "vid" : test_180312_pi13_102352.h264
-        rectype = "imgseq" : test_180312_pi13_img00231_101750.jpg
-        rectype = "vidseq" : test_180312_pi13_101810_S01.h264
-        """
+        if hasattr(self, "triggers"):
+            self.triggers.set()
+        else:
+            open(self.setupdir+"/trigger", "w").close()
 
-        self._setup_cam()
-        self._namefile()
-
-        if self.config.rec.rectype == "img":
-
-            self.filename = self.filename + strftime("%H%M%S") + self.filetype
-            self.cam.capture(self.filename, format="jpeg", resize = self.resize,
-                             quality = self.config.img.imgquality)
-            lineprint("Captured "+self.filename)
-
-        elif self.config.rec.rectype == "imgseq":
-
-            timepoint = datetime.now()
-            for i, img in enumerate(self.cam.capture_continuous(self.filename,
-                                    format="jpeg", resize = self.resize,
-                                    quality = self.config.img.imgquality)):
-                if i < self.config.img.imgnr-1:
-                    timepassed = (datetime.now() - timepoint).total_seconds()
-                    delay = max(0, self.config.img.imgwait - timepassed)
-                    lineprint("Captured "+img+", sleeping "+str(round(delay,2))+"s..")
-                    sleep(delay)
-                    timepoint = datetime.now()
-                else:
-                    lineprint("Captured "+img)
-                    break
 
-        elif self.config.rec.rectype in ["vid","vidseq"]:
+    def _flickerfix(self):
 
-            # Temporary fix for flicker at start of (first) video
-            self.cam.start_recording(BytesIO(), format = "h264",
-                                     resize = self.resize, level = "4.2")
-            self.cam.wait_recording(2)
-            self.cam.stop_recording()
+        """Temporary fix for flicker at start of (first) video"""
+
+        if self.flickerfixed:
+            return
+        self.cam.start_recording(BytesIO(), format = "h264",
+                                 resize = self.resize, level = "4.2")
+        self.cam.wait_recording(2)
+        self.cam.stop_recording()
+        self.flickerfixed = True
+
+
+    def _vidoutput(self, filename):
+
+        """Returns the output for a video, with a frame timestamp sidecar"""
+
+        if self.config.vid.timestamps == False:
+            return filename
+
+        return TimestampOutput(self.cam, filename)
+
+
+    def _closevid(self, output):
+
+        """Closes a video output and reports the achieved framerate"""
 
-            for session in ["_S%02d" % i for i in range(1,999)]:
-                session = "" if self.config.rec.rectype == "vid" else session
+        if isinstance(output, TimestampOutput):
+            output.close()
+            span = (output.last - output.first) / 1000000. if output.frames else 0
+            self.metrics.add(videos = 1, frames = output.frames, timespan = span,
+                             expected = int(round(span*self.cam.framerate))+1)
+            self.metrics.latencies += output.latencies
+            if output.started is not None and "firstframe" not in self.metrics.values:
+                self.metrics.set(firstframe = output.started-self.metrics.start)
+            values = self.metrics.values
+            fps = (values["frames"]-values["videos"]) / max(1e-9, values["timespan"])
+            self.metrics.set(fps = fps)
+            lineprint("Recorded "+str(output.frames)+" frames at "+\
+                      str(round(output.fps(), 2))+" fps (vidfps = "+\
+                      str(self.cam.framerate)+")..")
+
+
+    def _start_motion(self):
+
+        """Starts activity detection on a low resolution splitter port"""
+
+        from .motion import MotionDetector
+
+        wait = self.config.rec.motionwait
+        detector = MotionDetector(threshold = self.config.rec.motion,
+                                  wait = 5 if wait is None else wait,
+                                  framerate = self.cam.framerate)
+        self.cam.start_recording(detector, format = "yuv", splitter_port = 2,
+                                 resize = (detector.w, detector.h))
+        lineprint("Monitoring activity in roi..")
+
+        return detector
+
+
+    def _record_motion(self):
+
+        """Records videos only while activity is detected"""
+
+        detector = self._start_motion()
+        end = monotonic()+self.config.vid.vidduration+self.config.vid.viddelay
+        recording = False
+
+        try:
+            for session in ["_M%02d" % i for i in range(1,999)]:
+                while monotonic() < end and not detector.active():
+                    self.cam.wait_recording(0.1, splitter_port = 2)
+                if monotonic() >= end:
+                    break
                 filename = self.filename+strftime("%H%M%S")+session+self.filetype
-                self.cam.start_recording(filename, resize = self.resize,
+                output = self._vidoutput(filename)
+                self.cam.start_recording(output, format = "h264",
+                                         resize = self.resize,
                                          quality = self.config.vid.vidquality,
                                          level = "4.2")
-                lineprint("Start recording "+filename)
-                self.cam.wait_recording(self.config.vid.vidduration+self.config.vid.viddelay)
+                recording = True
+                lineprint("Activity detected, start recording "+filename)
+                while monotonic() < end and detector.active():
+                    self.cam.wait_recording(0.1)
                 self.cam.stop_recording()
+                recording = False
+                self._closevid(output)
                 lineprint("Finished recording "+filename)
-                if self.config.rec.rectype == "vid":
+        except KeyboardInterrupt:
+            lineprint("User terminated activity recording..")
+        finally:
+            if recording:
+                self.cam.stop_recording()
+                self._closevid(output)
+                lineprint("Finished recording "+filename)
+            self.cam.stop_recording(splitter_port = 2)
+            detector.stats()
+
+
+    def _record_segments(self):
+
+        """Records a single continuous video split into segment files"""
+
+        segduration = self.config.vid.segduration
+        segsize = self.config.vid.segsize
+        name = self.filename+strftime("%H%M%S")+"_seg%03d"+self.filetype
+        filename = name % 1
+        output = self._vidoutput(filename)
+        self.cam.start_recording(output, format = "h264", resize = self.resize,
+                                 quality = self.config.vid.vidquality,
+                                 level = "4.2",
+                                 intra_period = int(self.cam.framerate))
+        lineprint("Start recording "+filename)
+        end = monotonic()+self.config.vid.vidduration+self.config.vid.viddelay
+        segstart = monotonic()
+
+        try:
+            for segment in range(2,10000):
+                while monotonic() < end:
+                    self.cam.wait_recording(min(0.5, max(0, end-monotonic())))
+                    if segduration and monotonic()-segstart >= segduration:
+                        break
+                    if segsize and os.path.getsize(filename) >= segsize*1e6:
+                        break
+                if monotonic() >= end:
+                    break
+                newoutput = self._vidoutput(name % segment)
+                self.cam.split_recording(newoutput)
+                segstart = monotonic()
+                self._closevid(output)
+                lineprint("Finished segment "+filename+", continuing in "+\
+                          name % segment)
+                filename, output = name % segment, newoutput
+        except KeyboardInterrupt:
+            lineprint("User terminated segmented recording..")
+        finally:
+            self.cam.stop_recording()
+            self._closevid(output)
+            lineprint("Finished recording "+filename)
+
+
+    def _record_burst(self):
+
+        """Captures a burst of images through the video port"""
+
+        nr = self.config.img.imgnr
+        size = self.resize[0] * self.resize[1] // 2
+        buffers = [BytesIO(bytes(size)) for i in range(nr)]
+        times = []
+
+        def outputs():
+            for buffer in buffers:
+                buffer.seek(0)
+                yield buffer
+                times.append(monotonic())
+
+        lineprint("Capturing burst of "+str(nr)+" images..")
+        self.cam.capture_sequence(outputs(), format = "jpeg",
+                                  use_video_port = True, resize = self.resize,
+                                  quality = self.config.img.imgquality)
+        for t in times[:nr]:
+            self.metrics.frame(t)
+        self.metrics.set(expected = nr)
+
+        start = strftime("%H%M%S")
+        counter = "im%05d" if nr > 999 else "im%03d"
+        for i, buffer in enumerate(buffers):
+            filename = self.filename+counter % (i+1)+"_"+start+self.filetype
+            with open(filename, "wb") as f:
+                f.write(buffer.getbuffer()[:buffer.tell()])
+        stats = intervalstats(times)
+        lineprint("Captured "+str(nr)+" images at "+str(round(stats["fps"],2))+\
+                  " fps, interval min "+str(round(stats["min"]*1000,1))+\
+                  "ms, median "+str(round(stats["median"]*1000,1))+\
+                  "ms, p95 "+str(round(stats["p95"]*1000,1))+"ms, max "+\
+                  str(round(stats["max"]*1000,1))+"ms..")
+        self.metrics.set(fps = stats["fps"])
+
+
+    def _record_rawseq(self):
+
+        """Captures an image sequence into a memory-mapped numpy array"""
+
+        nr = self.config.img.imgnr
+        gray = self.config.img.rawformat != "yuv"
+        filename = self.filename+strftime("%H%M%S")+self.filetype
+        output = ArrayOutput(filename, nr, self.resize, gray = gray)
+        timer = DeadlineTimer(self.config.img.imgwait, nr)
+        captures = self.cam.capture_continuous(output, format = "yuv",
+                                               resize = self.resize)
+        lineprint("Capturing "+str(nr)+" "+("gray" if gray else "yuv")+\
+                  " frames into "+filename)
+
+        try:
+            while True:
+                timer.wait()
+                output.index = timer.slot
+                next(captures)
+                self.metrics.frame()
+                timer.mark(str(timer.slot))
+                delay = timer.next()
+                if delay is None:
                     break
-                else:
-                    msg = "\nPress Enter for new session, or e and Enter to exit: "
-                    if input(msg) == "e":
+                lineprint("Captured frame "+str(output.index)+", sleeping "+\
+                          str(round(delay,2))+"s..")
+        except KeyboardInterrupt:
+            lineprint("User terminated raw image sequence..")
+        finally:
+            captures.close()
+            output.close()
+            self.metrics.set(expected = nr)
+            lineprint("Stored "+str(output.frames)+" frames in "+filename)
+            timer.report(filename[:-len(self.filetype)]+"_timing.csv")
+
+
+    def _record_vidbuf(self):
+
+        """Records triggered videos from a continuous ring buffer"""
+
+        import picamera
+
+        bufsecs = self.config.vid.bufsecs if self.config.vid.bufsecs else 5
+        buffer = picamera.PiCameraCircularIO(self.cam, seconds = bufsecs)
+        self.cam.start_recording(buffer, format = "h264", resize = self.resize,
+                                 quality = self.config.vid.vidquality,
+                                 level = "4.2",
+                                 intra_period = int(self.cam.framerate))
+        self.triggers = Trigger(markerfile = self.setupdir+"/trigger")
+        buftime = self.config.vid.buftime
+        buftime = 3600 if buftime is None else buftime
+        end = monotonic() + buftime if buftime else None
+        lineprint("Buffering "+str(bufsecs)+"s of video, waiting for trigger..")
+
+        try:
+            for session in ["_T%02d" % i for i in range(1,999)]:
+                while not self.triggers.check():
+                    if end is not None and monotonic() >= end:
+                        self.triggers.stop()
                         break
-        self.cam.close()
+                    self.cam.wait_recording(0.1)
+                if self.triggers.stopped:
+                    lineprint("Stopped waiting for triggers..")
+                    break
+                filename = self.filename+strftime("%H%M%S")+session+self.filetype
+                video = self._vidoutput(filename)
+                f = open(video, "wb") if isinstance(video, str) else video
+                output = DeferredOutput(f)
+                try:
+                    self.cam.split_recording(output)
+                    if isinstance(f, TimestampOutput):
+                        f.copy(buffer, bufsecs)
+                    else:
+                        buffer.copy_to(f, seconds = bufsecs)
+                    buffer.clear()
+                    output.release()
+                    lineprint("Triggered recording "+filename)
+                    self.cam.wait_recording(self.config.vid.vidduration)
+                    self.cam.split_recording(buffer)
+                finally:
+                    if isinstance(video, str):
+                        f.close()
+                    self._closevid(video)
+                lineprint("Finished recording "+filename)
+        except KeyboardInterrupt:
+            lineprint("User terminated buffered recording..")
+        finally:
+            self.cam.stop_recording()
+            self.triggers.close()
+            del self.triggers
+
+
+    def record(self, keepcam = False):
+
+        """
+        Starts a recording as configured and returns either one or multiple
+        .h264 or .jpg files that are named automatically according to the label,
+        the host name, date, time and potentially session number or count nr.
+
+        Parameters
+        ----------
+        keepcam : bool, default = False
+            If the camera should be kept open after the recording, such that
+            subsequent recordings can start directly without having to set up
+            and warm up the camera again.
+
+        Example output files:
+        rectype = "img" : test_180312_pi13_101300.jpg
+        rectype = "vid" : test_180312_pi13_102352.h264
+        rectype = "imgseq" : test_180312_pi13_img00231_101750.jpg
+        rectype = "imgburst" : test_180312_pi13_im012_101750.jpg
+        rectype = "rawseq" : test_180312_pi13_101750.npy
+        rectype = "vidseq" : test_180312_pi13_101810_S01.h264
+        rectype = "vidseg" : test_180312_pi13_101810_seg001.h264
+        rectype = "vidbuf" : test_180312_pi13_101810_T01.h264
+        rectype = "vid" with motion : test_180312_pi13_101810_M01.h264
+        """
+
+        stored = None
+        if self.config.rec.storagecheck or self.config.rec.adaptive:
+            stored = copyconfig(self.config)
+            self._checkstorage()
+        if keepcam and hasattr(self, "cam") and \
+           self._camsettings() != self.camsettings:
+            self.cam.close()
+        try:
+            camtimes = {"setup": 0., "warmup": 0.}
+            if not keepcam or not hasattr(self, "cam") or self.cam.closed:
+                self._setup_cam()
+                camtimes = self.camtimes
+            self._namefile()
+            self.metrics = Metrics(host = self.host, label = self.config.rec.label,
+                                   rectype = self.config.rec.rectype)
+            self.metrics.set(**camtimes)
+
+            with RecordingLock(self.setupdir+"/recording.lock"):
+
+                if self.config.rec.rectype == "img":
+
+                    self.filename = self.filename + strftime("%H%M%S") + self.filetype
+                    self.cam.capture(self.filename, format="jpeg", resize = self.resize,
+                                     quality = self.config.img.imgquality)
+                    self.metrics.frame()
+                    self.metrics.set(expected = 1)
+                    lineprint("Captured "+self.filename)
+
+                elif self.config.rec.rectype == "imgseq":
+
+                    detector = self._start_motion() if self.config.rec.motion else None
+                    timer = DeadlineTimer(self.config.img.imgwait, self.config.img.imgnr)
+                    report = self.filename[:self.filename.find("im{counter")]
+                    report = report + strftime("%H%M%S") + "_timing.csv"
+                    output = self.filename
+                    if self.config.img.imgbuffer:
+                        writer = WriteBehind(maxsize = self.config.img.imgbuffer)
+                        output = BytesIO()
+                    captures = self.cam.capture_continuous(output, format="jpeg",
+                                            resize = self.resize,
+                                            quality = self.config.img.imgquality,
+                                            use_video_port = detector is not None)
+                    try:
+                        while True:
+                            timer.wait()
+                            if detector is not None and not detector.active():
+                                timer.idle()
+                                if timer.next() is None:
+                                    break
+                                continue
+                            img = next(captures)
+                            self.metrics.frame()
+                            if self.config.img.imgbuffer:
+                                img = self.filename.format(counter = len(timer.events)+1,
+                                                           timestamp = datetime.now())
+                                writer.put(img, output.getvalue())
+                                output.seek(0)
+                                output.truncate()
+                            timer.mark(img)
+                            delay = timer.next()
+                            if delay is None:
+                                lineprint("Captured "+img)
+                                break
+                            lineprint("Captured "+img+", sleeping "+str(round(delay,2))+"s..")
+                    except KeyboardInterrupt:
+                        lineprint("User terminated image sequence..")
+                    finally:
+                        captures.close()
+                        self.metrics.set(expected = self.config.img.imgnr-len(timer.idles))
+                        if self.config.img.imgbuffer:
+                            writer.close()
+                            self.metrics.latencies += writer.latencies
+                        if detector is not None:
+                            self.cam.stop_recording(splitter_port = 2)
+                            detector.stats()
+                        timer.report(report)
+
+                elif self.config.rec.rectype == "imgburst":
+
+                    self._record_burst()
+
+                elif self.config.rec.rectype == "rawseq":
+
+                    self._record_rawseq()
+
+                elif self.config.rec.rectype == "vid" and self.config.rec.motion:
+
+                    self._flickerfix()
+                    self._record_motion()
+
+                elif self.config.rec.rectype == "vidseg":
+
+                    self._flickerfix()
+                    self._record_segments()
+
+                elif self.config.rec.rectype == "vidbuf":
+
+                    self._flickerfix()
+                    self._record_vidbuf()
+
+                elif self.config.rec.rectype in ["vid","vidseq"]:
+
+                    self._flickerfix()
+                    for session in ["_S%02d" % i for i in range(1,999)]:
+                        session = "" if self.config.rec.rectype == "vid" else session
+                        filename = self.filename+strftime("%H%M%S")+session+self.filetype
+                        output = self._vidoutput(filename)
+                        self.cam.start_recording(output, format = "h264",
+                                                 resize = self.resize,
+                                                 quality = self.config.vid.vidquality,
+                                                 level = "4.2")
+                        lineprint("Start recording "+filename)
+                        self.cam.wait_recording(self.config.vid.vidduration+self.config.vid.viddelay)
+                        self.cam.stop_recording()
+                        self._closevid(output)
+                        lineprint("Finished recording "+filename)
+                        if self.config.rec.rectype == "vid":
+                            break
+                        else:
+                            msg = "\nPress Enter for new session, or e and Enter to exit: "
+                            if input(msg) == "e":
+                                break
+                self.metrics.collect(self.filename.split("{")[0])
+                self.metrics.write(self.logfolder+"metrics.jsonl",
+                                   self.config.rec.promfile)
+
+            if not keepcam:
+                self.cam.close()
+        finally:
+            if stored is not None:
+                self.config = stored
 
 
 def rec():
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import yaml
+from time import time, monotonic
+
+from pythutils.sysutils import lineprint
+
+def mountpoint(directory):
+
+    """Returns the mount point of the filesystem that directory is on"""
+
+    path = os.path.realpath(directory)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+def probe(directory, size = 32, blocksize = 1):
+
+    """
+    Measures the sustained sequential write throughput and the write latency
+    of the storage that directory is on, by writing a temporary file of size
+    MB in blocks of blocksize MB that are each synced to the storage medium.
+
+    Returns a dictionary with the throughput in MB/s and the latency
+    percentiles of writing a single block in seconds.
+    """
+
+    block = os.urandom(int(blocksize * 1e6))
+    nr = max(1, int(size / blocksize))
+    filename = os.path.join(directory, ".pirecorder_probe")
+    latencies = []
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        start = monotonic()
+        for i in range(nr):
+            t = monotonic()
+            os.write(fd, block)
+            os.fsync(fd)
+            latencies.append(monotonic() - t)
+        duration = monotonic() - start
+    finally:
+        os.close(fd)
+        os.remove(filename)
+
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies)-1, int(p * len(latencies)))]
+
+    result = {"throughput": nr * len(block) / 1e6 / duration,
+              "p50": percentile(0.5),
+              "p95": percentile(0.95),
+              "p99": percentile(0.99),
+              "max": latencies[-1]}
+
+    return result
+
+
+def storagespeed(directory, cachefile, refresh = False, maxage = 30):
+
+    """
+    Returns the probe result for the storage that directory is on. Results are
+    cached in cachefile per mount point and device, and only measured again
+    when refresh is True or when the cached result is older than maxage days.
+    """
+
+    mount = mountpoint(directory)
+    device = os.stat(directory).st_dev
+    cache = {}
+    if os.path.isfile(cachefile):
+        with open(cachefile) as f:
+            cache = yaml.safe_load(f) or {}
+
+    cached = cache.get(mount)
+    if not refresh and cached is not None and cached["device"] == device and \
+       time() - cached["date"] < maxage * 86400:
+        return cached
+
+    lineprint("Measuring write speed of storage at "+mount+"..")
+    result = probe(directory)
+    result.update({"device": device, "date": time()})
+    cache[mount] = result
+    with open(cachefile, "w") as f:
+        yaml.safe_dump(cache, f)
+    lineprint("Storage sustains "+str(round(result["throughput"], 1))+\
+              " MB/s, write latency median "+str(round(result["p50"]*1000, 1))+\
+              "ms, p95 "+str(round(result["p95"]*1000, 1))+"ms, p99 "+\
+              str(round(result["p99"]*1000, 1))+"ms..")
+
+    return result
+
+
+def _h264bytes(dims, quality):
+
+    """Estimated size in bytes of an h264 frame. Bitrate halves every 6
+    quality steps, and picamera limits the bitrate to 25Mbps"""
+
+    quality = 20 if quality in [None, 0] else quality
+    bits = dims[0] * dims[1] * 0.1 * 2 ** ((25 - quality) / 6.)
+
+    return bits / 8.
+
+
+def _jpegbytes(dims, quality):
+
+    """Estimated size in bytes of a jpeg image"""
+
+    bits = dims[0] * dims[1] * (0.5 + 2.5 * (quality / 100.) ** 2)
+
+    return bits / 8.
+
+
+def datarate(rectype, dims, quality, fps = None, wait = None, raw = "gray"):
+
+    """
+    Returns the predicted data rate in MB/s of a recording with the provided
+    recording type, frame dimensions, quality, and video framerate (for videos
+    and image bursts) or time between images (for image sequences)
+    """
+
+    if rectype in ["img", "imgseq"]:
+        return _jpegbytes(dims, quality) / max(wait, 0.01) / 1e6
+    if rectype == "imgburst":
+        return _jpegbytes(dims, quality) * fps / 1e6
+    if rectype == "rawseq":
+        factor = 1 if raw != "yuv" else 1.5
+        return dims[0] * dims[1] * factor / max(wait, 0.01) / 1e6
+
+    return min(_h264bytes(dims, quality) * fps, 25e6 / 8.) / 1e6
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import math
+from time import monotonic, sleep
+
+from pythutils.sysutils import lineprint
+
+class DeadlineTimer:
+
+    """
+    Paces a sequence of events on absolute deadlines of the monotonic clock.
+    Each slot i is due at start + i*interval, so that timing errors do not
+    accumulate over long sequences and changes of the wall clock (e.g. by NTP)
+    do not affect the timing. When an event overruns one or more deadlines,
+    those slots are skipped and flagged as missed instead of shifting all
+    subsequent slots.
+
+    Parameters
+    ----------
+    interval : float
+        Time in seconds between subsequent deadlines.
+    nr : int, default = None
+        Total number of slots in the sequence. None for an endless sequence.
+    tolerance : float, default = 0.5
+        Fraction of the interval that an event may start late before its slot
+        is considered missed.
+    """
+
+    def __init__(self, interval, nr = None, tolerance = 0.5):
+
+        self.interval = float(interval)
+        self.nr = nr
+        self.tolerance = tolerance * self.interval
+        self.start()
+
+
+    def start(self):
+
+        """Starts the sequence, with the first slot due immediately"""
+
+        self.t0 = monotonic()
+        self.slot = 0
+        self.woke = 0.
+        self.events = []
+        self.missed = []
+        self.idles = []
+
+
+    def now(self):
+
+        """Returns the time in seconds since the start of the sequence"""
+
+        return monotonic() - self.t0
+
+
+    def mark(self, label = ""):
+
+        """Registers the completion of the event of the current slot"""
+
+        deadline = self.slot * self.interval
+        self.events.append((self.slot, deadline, self.woke, self.now(), label))
+
+
+    def idle(self):
+
+        """Registers the current slot as deliberately left without an event"""
+
+        self.idles.append(self.slot)
+
+
+    def next(self):
+
+        """
+        Moves to the next slot that can still be met and returns the time in
+        seconds until it is due, or None when the sequence is finished
+        """
+
+        now = self.now()
+        slot = max(self.slot + 1,
+                   int(math.ceil((now - self.tolerance) / self.interval)))
+        if self.nr is not None:
+            slot = min(slot, self.nr)
+        missed = list(range(self.slot + 1, slot))
+        if len(missed) > 0:
+            self.missed.extend(missed)
+            lineprint("Missed "+str(len(missed))+" slot(s) due to overrun..")
+        self.slot = slot
+        if self.nr is not None and slot >= self.nr:
+            return None
+
+        return max(0, slot * self.interval - now)
+
+
+    def wait(self):
+
+        """Sleeps until the deadline of the current slot"""
+
+        delay = self.slot * self.interval - self.now()
+        if delay > 0:
+            sleep(delay)
+        self.woke = self.now()
+
+
+    def summary(self):
+
+        """Returns a dictionary with jitter and overrun statistics"""
+
+        jitter = [start - deadline for _, deadline, start, _, _ in self.events]
+        overruns = [e for e in self.events if e[3] > e[1] + self.interval]
+        stats = {"slots": len(self.events)+len(self.missed)+len(self.idles),
+                 "events": len(self.events),
+                 "missed": len(self.missed),
+                 "idle": len(self.idles),
+                 "overruns": len(overruns),
+                 "meanjitter": sum(jitter) / max(1, len(jitter)),
+                 "maxjitter": max(jitter) if len(jitter) > 0 else 0.}
+
+        return stats
+
+
+    def report(self, filename):
+
+        """Writes a per-slot jitter and overrun report in csv format"""
+
+        rows = [(slot, deadline, start, end, label, "")
+                for slot, deadline, start, end, label in self.events]
+        rows += [(slot, slot * self.interval, "", "", "", "missed")
+                 for slot in self.missed]
+        rows += [(slot, slot * self.interval, "", "", "", "idle")
+                 for slot in self.idles]
+        rows = sorted(rows, key=lambda row: row[0])
+        with open(filename, "w") as f:
+            f.write("slot,deadline,start,end,jitter,overrun,label,flag\n")
+            for slot, deadline, start, end, label, flag in rows:
+                if flag != "":
+                    f.write("%d,%.6f,,,,,,%s\n" % (slot, deadline, flag))
+                    continue
+                overrun = max(0, end - (deadline + self.interval))
+                f.write("%d,%.6f,%.6f,%.6f,%.6f,%.6f,%s,\n" % (slot, deadline,
+                        start, end, start - deadline, overrun, label))
+
+        stats = self.summary()
+        lineprint("Timing: "+str(stats["events"])+" of "+str(stats["slots"])+\
+                  " slots captured, max jitter "+\
+                  str(round(stats["maxjitter"]*1000, 1))+"ms, "+\
+                  str(stats["overruns"])+" overrun(s)..")
+
+        return stats
+
+
+def intervalstats(times):
+
+    """
+    Returns the achieved rate and the distribution of intervals (in seconds)
+    between subsequent event times
+    """
+
+    intervals = sorted(b - a for a, b in zip(times[:-1], times[1:]))
+    if len(intervals) == 0:
+        return {"fps": 0., "min": 0., "median": 0., "p95": 0., "max": 0.}
+
+    def percentile(p):
+        return intervals[min(len(intervals)-1, int(p * len(intervals)))]
+
+    stats = {"fps": len(intervals) / max(1e-9, times[-1] - times[0]),
+             "min": intervals[0],
+             "median": percentile(0.5),
+             "p95": percentile(0.95),
+             "max": intervals[-1]}
+
+    return stats
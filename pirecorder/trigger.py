@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import signal
+import threading
+
+class Trigger:
+
+    """
+    Collects recording triggers from a unix signal, a marker file, or a direct
+    call of the set() method, for example from another thread.
+
+    Parameters
+    ----------
+    markerfile : str, default = None
+        Path of a file whose creation triggers a recording. The file is
+        removed once the trigger has been registered.
+    signum : int, default = signal.SIGUSR1
+        Signal that triggers a recording. Only registered when the trigger is
+        created in the main thread.
+    """
+
+    def __init__(self, markerfile = None, signum = signal.SIGUSR1):
+
+        self.markerfile = markerfile
+        self.event = threading.Event()
+        self.stopped = False
+        self.signum = None
+
+        if signum is not None:
+            try:
+                self.previous = signal.signal(signum, self._handler)
+                self.signum = signum
+            except ValueError:
+                pass
+
+
+    def _handler(self, signum, frame):
+
+        self.event.set()
+
+
+    def set(self):
+
+        """Triggers a recording"""
+
+        self.event.set()
+
+
+    def stop(self):
+
+        """Stops waiting for triggers altogether"""
+
+        self.stopped = True
+        self.event.set()
+
+
+    def close(self):
+
+        """Restores the signal handler that was active before"""
+
+        if self.signum is not None:
+            signal.signal(self.signum, self.previous)
+            self.signum = None
+
+
+    def check(self):
+
+        """Returns if a trigger was registered, and resets it"""
+
+        if self.markerfile is not None and os.path.exists(self.markerfile):
+            os.remove(self.markerfile)
+            self.event.set()
+        triggered = self.event.is_set()
+        self.event.clear()
+
+        return triggered
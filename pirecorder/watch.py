@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import struct
+import select
+from time import time, monotonic
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+def _inotify():
+
+    """Returns the libc with inotify support, or None if not available"""
+
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+class Watcher:
+
+    """
+    Watches a directory for files that are completely written. With inotify
+    (linux), a file is reported when it is closed after writing or moved into
+    the directory, without scanning the directory. Elsewhere the directory is
+    scanned every interval seconds and files are reported once their size and
+    modification time no longer change.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to watch.
+    ext : str or tuple, default = None
+        Only report files with this extension, or all files if None.
+    interval : float, default = 5
+        Time in seconds between scans when inotify is not available.
+    """
+
+    def __init__(self, directory, ext = None, interval = 5):
+
+        self.directory = directory
+        self.ext = ext
+        self.interval = interval
+        self.fd = None
+
+        libc = _inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                mask = IN_CLOSE_WRITE | IN_MOVED_TO
+                if libc.inotify_add_watch(fd, directory.encode(), mask) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        if self.fd is None:
+            self.known = self._scan()
+            self.lastscan = monotonic()
+
+
+    def _match(self, name):
+
+        if name.startswith("."):
+            return False
+
+        return self.ext is None or name.endswith(self.ext)
+
+
+    def _scan(self):
+
+        stats = {}
+        for entry in os.scandir(self.directory):
+            if self._match(entry.name) and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_mtime, stat.st_size)
+
+        return stats
+
+
+    def wait(self, timeout = None):
+
+        """
+        Waits up to timeout seconds and returns the names of the files that
+        were completed, or None if events were lost and the directory should
+        be checked in full
+        """
+
+        if self.fd is None:
+            return self._poll(timeout)
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        data = os.read(self.fd, 65536)
+        names, i = [], 0
+        while i + 16 <= len(data):
+            _, mask, _, length = struct.unpack_from("iIII", data, i)
+            name = data[i+16:i+16+length].rstrip(b"\0").decode()
+            i += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if self._match(name) and name not in names:
+                names.append(name)
+
+        return names
+
+
+    def _poll(self, timeout):
+
+        wait = self.interval - (monotonic() - self.lastscan)
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            select.select([], [], [], wait)
+        if monotonic() - self.lastscan < self.interval:
+            return []
+
+        stats = self._scan()
+        self.lastscan = monotonic()
+        names = [name for name, stat in stats.items()
+                 if self.known.get(name) != stat and
+                 time() - stat[0] >= self.interval]
+        self.known = dict((name, self.known[name]) for name in stats
+                          if name in self.known)
+        for name in names:
+            self.known[name] = stats[name]
+
+        return sorted(names)
+
+
+    def close(self):
+
+        """Stops watching the directory"""
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
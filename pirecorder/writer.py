@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from queue import Queue
+from threading import Thread, Lock
+from time import monotonic
+
+from pythutils.sysutils import lineprint
+
+class WriteBehind:
+
+    """
+    Writes in-memory media buffers to disk with a bounded pool of background
+    writer threads, such that slow writes do not delay subsequent captures.
+    When the queue is full, put() blocks until a writer has caught up.
+
+    Parameters
+    ----------
+    maxsize : int, default = 8
+        Maximum number of buffers held in memory waiting to be written.
+    writers : int, default = 2
+        Number of background writer threads.
+    """
+
+    def __init__(self, maxsize = 8, writers = 2):
+
+        self.queue = Queue(maxsize = max(1, int(maxsize)))
+        self.depths = []
+        self.blocked = 0.
+        self.latencies = []
+        self.written = 0
+        self.errors = []
+        self.lock = Lock()
+
+        self.threads = [Thread(target = self._write) for i in range(writers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+
+    def put(self, filename, data):
+
+        """Queues data to be written to filename, blocks if queue is full"""
+
+        self.depths.append(self.queue.qsize())
+        start = monotonic()
+        self.queue.put((filename, data))
+        self.blocked += monotonic() - start
+
+
+    def _write(self):
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            filename, data = item
+            start = monotonic()
+            try:
+                with open(filename, "wb") as f:
+                    f.write(data)
+                with self.lock:
+                    self.written += len(data)
+            except (IOError, OSError) as e:
+                self.errors.append(filename)
+                lineprint("Failed writing "+filename+": "+str(e))
+            self.latencies.append(monotonic() - start)
+            self.queue.task_done()
+
+
+    def stats(self):
+
+        """Returns a dictionary with queue depth and write statistics"""
+
+        nr = len(self.latencies)
+        stats = {"files": nr,
+                 "bytes": self.written,
+                 "errors": len(self.errors),
+                 "meandepth": sum(self.depths) / max(1, len(self.depths)),
+                 "maxdepth": max(self.depths) if len(self.depths) > 0 else 0,
+                 "blocked": self.blocked,
+                 "meanlatency": sum(self.latencies) / max(1, nr),
+                 "maxlatency": max(self.latencies) if nr > 0 else 0.}
+
+        return stats
+
+
+    def close(self):
+
+        """Waits for all queued buffers to be written and stops the writers"""
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        stats = self.stats()
+        lineprint("Wrote "+str(stats["files"])+" files, max queue depth "+\
+                  str(stats["maxdepth"])+", blocked "+\
+                  str(round(stats["blocked"], 2))+"s, max write latency "+\
+                  str(round(stats["maxlatency"]*1000, 1))+"ms..")
+
+        return stats
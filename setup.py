@@ -58,6 +58,8 @@ if __name__ == "__main__":
                             "stream = pirecorder.stream:strm",
                             "camconfig = pirecorder.camconfig:config",
                             "record = pirecorder.pirecorder:rec",
+                            "recorderd = pirecorder.daemon:recd",
+                            "offload = pirecorder.offload:offl",
                             "schedule = pirecorder.schedule:sch",
                             "convert = pirecorder.convert:conv"],},
           download_url=DOWNLOAD_URL,
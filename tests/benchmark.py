@@ -0,0 +1,299 @@
+#! /usr/bin/env python
+"""
+Copyright (c) 2020 Jolle Jolles <j.w.jolles@gmail.com>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Benchmarks for the performance critical parts of pirecorder. These do not
+# need a camera and can be run on any computer. Run all benchmarks with
+# "python benchmark.py" or specific benchmarks with e.g.
+# "python benchmark.py imports". A benchmark fails if its budget is exceeded.
+
+import os
+import sys
+import shutil
+import tempfile
+import socket
+import threading
+import subprocess
+from time import perf_counter, sleep
+
+rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, rootdir)
+
+# Entry point modules, the time budget for importing them in seconds, and the
+# modules they should not import
+entrypoints = {"record": ("pirecorder.pirecorder", 0.5,
+                          ["cv2", "numpy", "crontab", "cron_descriptor",
+                           "multiprocess", "pythutils.drawutils"]),
+               "schedule": ("pirecorder.schedule", 0.5,
+                            ["cv2", "numpy", "multiprocess",
+                             "pythutils.drawutils"]),
+               "convert": ("pirecorder.convert", 2.0,
+                           ["crontab", "cron_descriptor",
+                            "pythutils.drawutils"]),
+               "stream": ("pirecorder.stream", 3.0,
+                          ["crontab", "cron_descriptor", "multiprocess"]),
+               "camconfig": ("pirecorder.camconfig", 2.0,
+                             ["crontab", "cron_descriptor", "multiprocess"]),
+               "offload": ("pirecorder.offload", 0.5,
+                           ["cv2", "numpy", "crontab", "cron_descriptor",
+                            "multiprocess", "pythutils.drawutils"])}
+
+def bench_imports(repeats = 5):
+
+    """Measures the import time of each entry point in a fresh interpreter"""
+
+    code = "import sys, time; t = time.perf_counter(); import %s; " +\
+           "print(time.perf_counter() - t); print(' '.join(sys.modules))"
+    failed = []
+    for entry, (module, budget, forbidden) in entrypoints.items():
+        times = []
+        for i in range(repeats):
+            out = subprocess.check_output([sys.executable, "-c", code % module],
+                                          cwd = rootdir)
+            duration, modules = out.decode().strip().split("\n")[-2:]
+            times.append(float(duration))
+        loaded = [m for m in forbidden if m in modules.split(" ")]
+        best = min(times)
+        print("%-10s %7.1fms (budget %6.1fms)" % (entry, best*1000, budget*1000))
+        if best > budget:
+            failed.append(entry+" exceeds import time budget")
+        if len(loaded) > 0:
+            failed.append(entry+" imports "+", ".join(loaded))
+
+    return failed
+
+
+def bench_decode(nr = 48, dims = (1640, 1232), workers = 4):
+
+    """
+    Compares decoding a synthetic jpeg corpus one image at a time at full
+    resolution with the parallel, order-preserving (reduced) decoding used to
+    convert image sequences to video
+    """
+
+    import cv2
+    import numpy as np
+    from pythutils.mediautils import imgresize
+    from pirecorder.convert import decodeframes
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        noise = np.random.RandomState(1).randint(0, 255, (dims[1]//8, dims[0]//8, 3))
+        background = cv2.resize(noise.astype(np.uint8), dims)
+        filenames = []
+        for i in range(nr):
+            img = background.copy()
+            cv2.putText(img, str(i), (100, 400), cv2.FONT_HERSHEY_SIMPLEX, 12,
+                        (255, 255, 255), 20)
+            filenames.append(os.path.join(tmpdir, "seq_%04d.jpg" % i))
+            cv2.imwrite(filenames[-1], img)
+
+        failed = []
+        for resizeval in [1, 0.5, 0.25]:
+            start = perf_counter()
+            for filename in filenames:
+                frame = cv2.imread(filename)
+                if resizeval != 1:
+                    frame = imgresize(frame, resizeval)
+            serial = perf_counter() - start
+
+            start = perf_counter()
+            order = [f for f, _ in decodeframes(filenames, resizeval, workers)]
+            parallel = perf_counter() - start
+
+            print("resize %-5s serial %6.1ffps, parallel %6.1ffps (%.1fx)" %
+                  (resizeval, nr/serial, nr/parallel, serial/parallel))
+            if order != filenames:
+                failed.append("decode order not preserved")
+            if resizeval < 1 and parallel > serial:
+                failed.append("reduced decode slower than full decode")
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return failed
+
+
+def bench_withframe(seconds = 10, dims = (640, 480), fps = 25):
+
+    """
+    Compares drawing frame numbers on a synthetic h264 clip frame by frame with
+    OpenCV with drawing them with FFmpeg's drawtext filter while re-encoding
+    """
+
+    from pirecorder.convert import Convert, hasfilter
+
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg not found, skipping..")
+        return []
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        indir = os.path.join(tmpdir, "in")
+        os.makedirs(indir)
+        subprocess.check_output(["ffmpeg", "-f", "lavfi", "-i", "testsrc=d=" +
+                                 str(seconds)+":s=%dx%d:r=%d" % (dims+(fps,)),
+                                 "-vcodec", "libx264", "-g", str(fps),
+                                 os.path.join(indir, "clip.h264"),
+                                 "-y", "-nostats", "-loglevel", "0"])
+
+        paths = [("opencv", "opencv")]
+        if hasfilter("drawtext"):
+            paths.append(("ffmpeg", True))
+        else:
+            print("ffmpeg has no drawtext filter, skipping ffmpeg path..")
+        times = {}
+        for name, withframe in paths:
+            outdir = os.path.join(tmpdir, name)
+            start = perf_counter()
+            Convert(indir, outdir, withframe = withframe, pools = 1, fps = fps)
+            times[name] = perf_counter() - start
+            print("%-7s %7.1ffps" % (name, seconds*fps/times[name]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+    failed = []
+    if "ffmpeg" in times:
+        print("speedup %7.1fx" % (times["opencv"]/times["ffmpeg"]))
+        if times["ffmpeg"] > times["opencv"]:
+            failed.append("ffmpeg withframe slower than opencv withframe")
+
+    return failed
+
+
+def _offloaded(source, target, names):
+
+    """Returns the names of the files that differ between source and target"""
+
+    differ = []
+    for name in names:
+        path = os.path.join(target, name)
+        if not os.path.isfile(path):
+            differ.append(name)
+            continue
+        with open(os.path.join(source, name), "rb") as a, open(path, "rb") as b:
+            if a.read() != b.read():
+                differ.append(name)
+
+    return differ
+
+
+def bench_offload(nr = 4, size = 8):
+
+    """
+    Measures the offload rate of synthetic recordings of size MB to a local
+    directory and to an OffloadServer on localhost, and checks that files are
+    verified, skipped when kept and unchanged, resumed after an interruption,
+    retried after a checksum mismatch, and removed locally once offloaded
+    """
+
+    from pirecorder.offload import Offload, OffloadServer
+
+    tmpdir = tempfile.mkdtemp()
+    failed = []
+    try:
+        source = os.path.join(tmpdir, "recordings")
+        os.makedirs(os.path.join(source, "sub"))
+        names = ["rec_%02d.h264" % i for i in range(nr-1)] + ["sub/rec.h264"]
+        for name in names:
+            with open(os.path.join(source, name), "wb") as f:
+                f.write(os.urandom(int(size*1e6)))
+        lockfile = os.path.join(tmpdir, "recording.lock")
+
+        serverdir = os.path.join(tmpdir, "server")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        threading.Thread(target = OffloadServer, args = (serverdir, port),
+                         daemon = True).start()
+        for i in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                sleep(0.1)
+
+        targets = [("dir", os.path.join(tmpdir, "target"),
+                    os.path.join(tmpdir, "target")),
+                   ("tcp", "127.0.0.1:"+str(port), serverdir)]
+        for kind, target, directory in targets:
+            manifest = os.path.join(source, ".offloaded")
+            if os.path.exists(manifest):
+                os.remove(manifest)
+            offload = lambda keep: Offload(source, target, wait = 0, keep = keep,
+                                           lockfile = lockfile)
+
+            start = perf_counter()
+            offload(True)
+            duration = perf_counter() - start
+            print("%-4s %7.1fMB/s" % (kind, nr*size/duration))
+            if len(_offloaded(source, directory, names)) > 0:
+                failed.append(kind+" offload incomplete")
+
+            mtimes = [os.path.getmtime(os.path.join(directory, n)) for n in names]
+            offload(True)
+            if mtimes != [os.path.getmtime(os.path.join(directory, n))
+                          for n in names]:
+                failed.append(kind+" kept files offloaded again")
+
+            with open(os.path.join(source, names[0]), "ab") as f:
+                f.write(b"resumed")
+            with open(os.path.join(source, names[0]), "rb") as f:
+                data = f.read()
+            with open(os.path.join(directory, names[0])+".partial", "wb") as f:
+                f.write(data[:len(data)//2])
+            offload(True)
+            if len(_offloaded(source, directory, names)) > 0:
+                failed.append(kind+" resumed offload incorrect")
+
+            with open(os.path.join(source, names[1]), "ab") as f:
+                f.write(b"corrupted")
+            with open(os.path.join(directory, names[1])+".partial", "wb") as f:
+                f.write(os.urandom(len(data)//2))
+            offload(True)
+            if names[1] not in _offloaded(source, directory, names):
+                failed.append(kind+" corrupted offload not rejected")
+            offload(True)
+            if len(_offloaded(source, directory, names)) > 0:
+                failed.append(kind+" corrupted offload not retried")
+
+        offload(False)
+        remaining = [n for n in names if os.path.exists(os.path.join(source, n))]
+        if len(remaining) > 0:
+            failed.append("offloaded files not removed locally")
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return failed
+
+
+benchmarks = {"imports": bench_imports,
+              "decode": bench_decode,
+              "withframe": bench_withframe,
+              "offload": bench_offload}
+
+if __name__ == "__main__":
+
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks)
+    failed = []
+    for name in names:
+        print("BENCHMARK: "+name)
+        failed += benchmarks[name]()
+        print("DONE..\n")
+    for message in failed:
+        print("FAILED: "+message)
+    sys.exit(1 if len(failed) > 0 else 0)
@@ -70,19 +70,52 @@ rec.settings(rectype = "imgseq", imgnr = 10, imgtime = 60, imgwait = 5,
 rec.record()
 print("DONE..\n")
 
-# Test recording 3: a single 10s video
+# Test recording 3: a burst of 30 images
+print("TEST: recording a burst of 30 images")
+rec.settings(rectype = "imgburst", imgnr = 30, vidfps = 30, subdirs = False)
+rec.record()
+print("DONE..\n")
+
+# Test recording 4: a raw sequence of 10 gray frames into a numpy file
+print("TEST: recording a raw sequence of 10 gray frames, 1s apart")
+rec.settings(rectype = "rawseq", imgnr = 10, imgwait = 1, rawformat = "gray")
+rec.record()
+print("DONE..\n")
+
+# Test recording 5: a single 10s video
 print("TEST: recording a 10s video")
 rec.settings(rectype = "vid", vidduration = 10, viddelay = 0, subdirs = False)
 rec.record()
 print("DONE..\n")
 
-# Test recording 4: a sequence of videos
+# Test recording 6: a sequence of videos
 print("TEST: recording a sequence of videos")
 rec.settings(rectype = "vidseq")
 rec.record()
 time.sleep(1)
 print("DONE..\n")
 
+# Test recording 7: a segmented video
+print("TEST: recording a 60s video in segments of 20s")
+rec.settings(rectype = "vidseg", vidduration = 60, segduration = 20)
+rec.record()
+print("DONE..\n")
+
+# Test recording 8: triggered videos from a ring buffer
+print("TEST: recording a triggered video with 5s before the trigger")
+rec.settings(rectype = "vidbuf", bufsecs = 5, vidduration = 5, buftime = 60)
+print("Trigger with: touch ~/pirecorder/trigger, stops after 60s")
+rec.record()
+print("DONE..\n")
+
+# Test recording 9: videos only during activity
+print("TEST: recording videos only during activity for 60s")
+rec.settings(rectype = "vid", motion = 0.005, motionwait = 5,
+             vidduration = 60)
+rec.record()
+rec.settings(motion = 0)
+print("DONE..\n")
+
 # Run video stream
 print("TEST: run video stream")
 print("Function records mouse clicks and movements and responds to keypresses:")